@@ -26,12 +26,88 @@ stMsgTyp = POINTER(c_uint)
 pData = POINTER(c_ubyte)
 EventInfoCallBack = winfun_ctype(None, stMsgTyp, c_void_p)
 
+# Политики переполнения очереди кадров
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+BLOCK = "block"
+FRAME_QUEUE_SIZE = 8
+
+
+class FrameQueue(Queue):
+    """Ограниченная очередь кадров с выбираемой политикой переполнения.
+
+    drop-oldest — выбрасывается самый старый кадр, drop-newest — новый кадр не
+    кладётся, block — put() ждёт потребителя, как обычная Queue. Память не
+    растёт при любой скорости потребителя.
+    """
+
+    def __init__(self, maxsize=FRAME_QUEUE_SIZE, policy=DROP_OLDEST):
+        if maxsize < 1:
+            raise ValueError("maxsize must be >= 1")
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError("unknown overflow policy: %s" % policy)
+        Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    @property
+    def depth(self):
+        return self.qsize()
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == BLOCK:
+            return Queue.put(self, item, block, timeout)
+
+        with self.not_full:
+            if self._qsize() >= self.maxsize:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return
+                # Выброшенный кадр никто не подтвердит через task_done()
+                self._get()
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class FramePool:
+    """Переиспользуемые буферы кадров одного размера.
+
+    Буфер выдаётся повторно, только когда на него больше никто не ссылается
+    (потребитель отпустил кадр или очередь его выбросила), поэтому кадр в
+    очереди никогда не перезаписывается. В установившемся режиме новых
+    выделений памяти нет.
+    """
+
+    def __init__(self, max_buffers=FRAME_QUEUE_SIZE + 4):
+        self.max_buffers = max_buffers
+        self.shape = None
+        self.buffers = []
+
+    def acquire(self, shape):
+        if shape != self.shape:
+            self.shape = shape
+            self.buffers = []
+        for buf in self.buffers:
+            # Ссылки: список + переменная цикла + аргумент getrefcount
+            if sys.getrefcount(buf) == 3:
+                return buf
+        buf = np.empty(shape, dtype=np.uint8)
+        if len(self.buffers) < self.max_buffers:
+            self.buffers.append(buf)
+        return buf
+
+
 class Camera:
-    def __init__(self,camStr="EngravingLinesB\x00"):
+    def __init__(self,camStr="EngravingLinesB\x00", queue_size=FRAME_QUEUE_SIZE, overflow=DROP_OLDEST):
         self.cam = None
         self.g_bExit = False
         self.g_bConnect = False
-        self.frame_queue = Queue()
+        self.frame_queue = FrameQueue(queue_size, overflow)
+        # Буфер для конвертации в BGR (внутренний) и пул буферов для готовых кадров
+        self.bgr_buf = None
+        self.frame_pool = FramePool(queue_size + 4)
         self.trigger=False
         self.camStr=camStr
         #self.config_instance = Config()
@@ -237,56 +313,35 @@ class Camera:
                 print("error: unable to start thread")
         pass
 
-    def convert_pixel_format(self, data_buf, stFrameInfo):
-        nparr = None
-        pDataForRGB = stFrameInfo.nWidth * stFrameInfo.nHeight * 3
-        if pDataForRGB is not None:
-            # 填充存图参数
-            # fill in the parameters  of save image
-
-            stConvertParam = MV_CC_PIXEL_CONVERT_PARAM()
-            memset(byref(stConvertParam), 0, sizeof(stConvertParam))
-            # // 从上到下依次是：输出图片格式，输入数据的像素格式，提供的输出缓冲区大小，图像宽，
-            # // 图像高，输入数据缓存，输出图片缓存，JPG编码质量
-            # Top to bottom are：
-            stConvertParam.nWidth = stFrameInfo.nWidth
-            stConvertParam.nHeight = stFrameInfo.nHeight
-            print(type(data_buf))
-            stConvertParam.pSrcData = data_buf
-            stConvertParam.nSrcDataLen = stFrameInfo.nFrameLen
-            stConvertParam.enSrcPixelType = stFrameInfo.enPixelType
-            stConvertParam.enDstPixelType = PixelType_Gvsp_RGB8_Packed
-            stConvertParam.pDstBuffer = (c_ubyte * pDataForRGB)()
-            stConvertParam.nDstBufferSize = pDataForRGB
-            ret = self.cam.MV_CC_ConvertPixelType(stConvertParam)
-            print(">>>>> RET >>>>>>",ret)
-            if ret != 0:
-                print("convert pixel fail! ret[0x%x]" % ret)
-                del data_buf
-                sys.exit()
-
-            # print("Convent OK")
-            try:
-                img_buff = (c_ubyte * stConvertParam.nDstLen)()
-                memmove(byref(img_buff), stConvertParam.pDstBuffer, stConvertParam.nDstLen)
-
-                nparr = np.frombuffer(img_buff, np.uint8)
-                # print("shape of buffer ", nparr.shape)
-                # print(nparr)
-                nparr = nparr.reshape(stFrameInfo.nHeight, stFrameInfo.nWidth, 3)
-                nparr = cv2.cvtColor(nparr, cv2.COLOR_RGB2BGR)
-                # cv2.imshow('Yolo_nparr',nparr)
-                # cv2.waitKey(0)
-                # cv2.destroyAllWindows()
-                # nparr = cv2.rotate(nparr, cv2.ROTATE_180)
-                # nparr = cv2.resize(nparr, config_instance.get_Img_resize())
-                # yolo = 0
-                # result = yolo_det.presenceCheck(nparr)
-                # print("YOLO INF IN CAMERA MODULE",time.time()-yolo)
-                # self.frame_queue.put([nparr, result])
-            except:
-                raise Exception("save file executed failed")
+    def convert_to_bgr(self, data_buf, stFrameInfo):
+        """Конвертация SDK сразу в BGR8 во внутренний переиспользуемый буфер"""
+        shape = (stFrameInfo.nHeight, stFrameInfo.nWidth, 3)
+        if self.bgr_buf is None or self.bgr_buf.shape != shape:
+            self.bgr_buf = np.empty(shape, dtype=np.uint8)
+
+        stConvertParam = MV_CC_PIXEL_CONVERT_PARAM()
+        memset(byref(stConvertParam), 0, sizeof(stConvertParam))
+        stConvertParam.nWidth = stFrameInfo.nWidth
+        stConvertParam.nHeight = stFrameInfo.nHeight
+        stConvertParam.pSrcData = data_buf
+        stConvertParam.nSrcDataLen = stFrameInfo.nFrameLen
+        stConvertParam.enSrcPixelType = stFrameInfo.enPixelType
+        stConvertParam.enDstPixelType = PixelType_Gvsp_BGR8_Packed
+        stConvertParam.pDstBuffer = self.bgr_buf.ctypes.data_as(POINTER(c_ubyte))
+        stConvertParam.nDstBufferSize = self.bgr_buf.nbytes
+        ret = self.cam.MV_CC_ConvertPixelType(stConvertParam)
+        if ret != 0:
+            print("convert pixel fail! ret[0x%x]" % ret)
+            return None
+        return self.bgr_buf
 
+    def convert_pixel_format(self, data_buf, stFrameInfo):
+        bgr = self.convert_to_bgr(data_buf, stFrameInfo)
+        if bgr is None:
+            return None
+        # Внутренний буфер перезапишется следующим кадром — отдаём буфер из пула
+        nparr = self.frame_pool.acquire(bgr.shape)
+        np.copyto(nparr, bgr)
         return nparr
 
     def image_buf_thread(self, nPayloadSize=0):
@@ -326,63 +381,22 @@ class Camera:
             # input("Press enter to capture frame-------------")
 
             ret = self.cam.MV_CC_GetOneFrameTimeout(byref(data_buf), nPayloadSize, stFrameInfo, 1000)
+            if ret != 0:
+                continue
             if self.trigger:
-
-                pDataForRGB = stFrameInfo.nWidth * stFrameInfo.nHeight * 3
-                if pDataForRGB is not None:
-                    # 填充存图参数
-                    # fill in the parameters  of save image
-
-                    stConvertParam = MV_CC_PIXEL_CONVERT_PARAM()
-                    memset(byref(stConvertParam), 0, sizeof(stConvertParam))
-                    # // 从上到下依次是：输出图片格式，输入数据的像素格式，提供的输出缓冲区大小，图像宽，
-                    # // 图像高，输入数据缓存，输出图片缓存，JPG编码质量
-                    # Top to bottom are：
-                    stConvertParam.nWidth = stFrameInfo.nWidth
-                    stConvertParam.nHeight = stFrameInfo.nHeight
-                    # print(type(data_buf))
-                    stConvertParam.pSrcData = data_buf
-                    stConvertParam.nSrcDataLen = stFrameInfo.nFrameLen
-                    stConvertParam.enSrcPixelType = stFrameInfo.enPixelType
-                    stConvertParam.enDstPixelType = PixelType_Gvsp_RGB8_Packed
-                    stConvertParam.pDstBuffer = (c_ubyte * pDataForRGB)()
-                    stConvertParam.nDstBufferSize = pDataForRGB
-                    nRet = self.cam.MV_CC_ConvertPixelType(stConvertParam)
-                    # print(ret)
-                    if ret != 0:
-                        print("convert pixel fail! ret[0x%x]" % ret)
-                        del data_buf
-                        sys.exit()
-
-                    # print("Convent OK")
-                    try:
-                        img_buff = (c_ubyte * stConvertParam.nDstLen)()
-                        memmove(byref(img_buff), stConvertParam.pDstBuffer, stConvertParam.nDstLen)
-
-                        nparr = np.frombuffer(img_buff, np.uint8)
-                        # print("shape of buffer ", nparr.shape)
-                        # print(nparr)
-                        
-                        nparr = nparr.reshape(stFrameInfo.nHeight, stFrameInfo.nWidth, 3)
-                        nparr = cv2.cvtColor(nparr, cv2.COLOR_RGB2BGR)
-                        #print("NPARR",nparr)
-                        if nparr is not None:
-                            #Sprint("-----------------------------------------",nparr.shape)
-                        # self.frame=nparr
-                            #frame = cv2.resize(nparr, self.config_instance.get_Img_resize())
-                            frame = cv2.rotate(nparr, cv2.ROTATE_180)
-                            #result = self.yolo_det.presenceCheck(frame)
-                            #print("Result in Yolo",result)
-                            #if result !=[]:
-                            self.frame_queue.put(frame)
-                        else:
-                            #print("Result in Yolo",result)
-                            print("Image is None")
-                            #self.frame_queue.put([nparr,result])
-                        
-
-                    except:
-                        raise Exception("save file executed failed")
+                bgr = self.convert_to_bgr(data_buf, stFrameInfo)
+                if bgr is None:
+                    del data_buf
+                    sys.exit()
+
+                # Поворот на 180° сразу в буфер из пула, без промежуточных массивов
+                frame = self.frame_pool.acquire(bgr.shape)
+                cv2.rotate(bgr, cv2.ROTATE_180, dst=frame)
+                #result = self.yolo_det.presenceCheck(frame)
+                #print("Result in Yolo",result)
+                #if result !=[]:
+                self.frame_queue.put(frame)
+                del frame
     # def get_img(self):
     #     return self.frame
 
@@ -431,7 +445,7 @@ if __name__ == "__main__":
     while True:
         try:
             frame = camera.frame_queue.get()
-            print(frame.shape)
+            print(frame.shape, "depth:", camera.frame_queue.depth, "dropped:", camera.frame_queue.dropped)
         except:
             print('no frame')
             pass
@@ -1,12 +1,17 @@
-from flask import Flask, Response, render_template
+from flask import Flask, Response, render_template, request
 from MvCameraControl_class import *
-import cv2
 import numpy as np
 from ctypes import *
+import os
 import sys
-import time
 import threading
 
+# Общие этапы обработки кадра лежат в корне проекта (SDK берётся локальный — он раньше в sys.path)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from encoding import MJPEG_MIMETYPE, mjpeg_stream
+from image_processing import (STAGE_ENCODE, STAGE_SCENE_GAIN, ExposureController, ProcessingPipeline,
+                              parse_stages)
+
 app = Flask(__name__)
 
 # Коды ошибок
@@ -17,8 +22,51 @@ MV_OK = 0  # Успешное выполнение
 camera = None
 camera_thread = None
 streaming = False
-frame = None
-lock = threading.Lock()
+# Экспозицию ведёт камера (ExposureAuto). Яркость правит прежняя пороговая коррекция по среднему
+# (scene-gain), а не замер и мягкое усиление backend — контроллер этим этапам не нужен
+processing = ProcessingPipeline(ExposureController(), mono=True, stages=(STAGE_SCENE_GAIN, STAGE_ENCODE))
+
+
+class FrameSlot:
+    """Последний JPEG с порядковым номером: передача кадров от CameraThread зрителям.
+
+    Зритель ждёт на Condition кадр новее своего курсора — дубликатов нет, в
+    ожидании CPU не тратится. close() будит зрителей, подключившихся до
+    остановки стрима, и завершает их потоки.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._frame = None
+        self._generation = 0
+
+    def publish(self, frame):
+        with self._cond:
+            self._seq += 1
+            self._frame = frame
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._generation += 1
+            self._frame = None
+            self._cond.notify_all()
+
+    def frames(self):
+        """Новые кадры для одного зрителя; генератор завершается при остановке стрима"""
+        with self._cond:
+            cursor, generation = self._seq, self._generation
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._generation != generation or self._seq != cursor)
+                if self._generation != generation:
+                    return
+                cursor, frame = self._seq, self._frame
+            yield frame
+
+
+frame_slot = FrameSlot()
 
 
 class CameraThread(threading.Thread):
@@ -27,7 +75,7 @@ class CameraThread(threading.Thread):
         self.stop_event = threading.Event()
 
     def run(self):
-        global camera, frame, streaming
+        global camera, streaming
 
         # Инициализация камеры
         device_list = MV_CC_DEVICE_INFO_LIST()
@@ -97,20 +145,10 @@ class CameraThread(threading.Thread):
                 img_np = np.frombuffer(buffer, dtype=np.uint8)
                 img_np = img_np.reshape((stFrame.stFrameInfo.nHeight, stFrame.stFrameInfo.nWidth))
 
-                # Оптимизация изображения
-                current_mean = np.mean(img_np)
-                if current_mean < 30:
-                    img_np = cv2.equalizeHist(img_np)
-                elif current_mean > 200:
-                    img_np = cv2.convertScaleAbs(img_np, alpha=0.7, beta=0)
-                else:
-                    img_np = cv2.convertScaleAbs(img_np, alpha=1.2, beta=10)
-
-                # Кодирование в JPEG
-                ret, jpeg = cv2.imencode('.jpg', img_np)
-                if ret:
-                    with lock:
-                        frame = jpeg.tobytes()
+                # Оптимизация изображения и кодирование в JPEG (этапы processing)
+                jpeg = processing.run(img_np)
+                if jpeg is not None:
+                    frame_slot.publish(jpeg)
 
                 # Освобождаем буфер
                 cam.MV_CC_FreeImageBuffer(stFrame)
@@ -124,17 +162,11 @@ class CameraThread(threading.Thread):
                 MvCamCtrldll.MV_CC_DestroyHandle(cam.handle)
             streaming = False
             camera = None
+            frame_slot.close()
 
 
 def generate_frames():
-    global frame
-    while True:
-        with lock:
-            if frame is not None:
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-            else:
-                time.sleep(0.1)
+    return mjpeg_stream(frame_slot.frames())
 
 
 @app.route('/')
@@ -144,8 +176,7 @@ def index():
 
 @app.route('/video_feed')
 def video_feed():
-    return Response(generate_frames(),
-                    mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(generate_frames(), mimetype=MJPEG_MIMETYPE)
 
 
 @app.route('/start_stream')
@@ -175,5 +206,20 @@ def stream_status():
     return {'streaming': streaming}
 
 
+@app.route('/processing')
+def processing_status():
+    # ?stages=scene-gain,encode — порядок и состав этапов обработки; ?rotate=0|90|180|270 — поворот кадра
+    stages = request.args.get('stages')
+    rotate = request.args.get('rotate', type=int)
+    try:
+        if stages is not None:
+            processing.configure(parse_stages(stages))
+        if rotate is not None:
+            processing.set_rotation(rotate)
+    except ValueError as e:
+        return {'status': 'error', 'message': str(e)}, 400
+    return processing.status()
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
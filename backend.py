@@ -1,5 +1,8 @@
 # Импорт необходимых библиотек
+import itertools
 import math
+import queue
+import sys
 import threading
 import time
 
@@ -12,12 +15,17 @@ from scipy.interpolate import Akima1DInterpolator
 import re
 from typing import List
 from werkzeug.exceptions import HTTPException
+from werkzeug.security import safe_join
 from MvCameraControl_class import *
 import cv2
 from ctypes import *# Коды ошибок
 from scipy.ndimage import gaussian_filter1d
+from encoding import (ENCODER_OPENCV, MJPEG_MIMETYPE, EncoderPool, JpegSettings, available_encoders, make_encoder,
+                      mjpeg_part, select_encoder)
+from frame_ring import FrameRingReader, ring_name
+from image_processing import (ExposureController, Meter, METER_STRIDE, ProcessingPipeline, TemporalDenoiser,
+                              parse_stages)
 
-MV_E_NO_DATA = -2147483644  # 0x80000004: Нет данных
 MV_OK = 0  # Успешное выполнение
 
 # Создание экземпляра Flask приложения
@@ -26,26 +34,585 @@ CORS(app)
 
 from pydantic import BaseModel
 
-camera_lock = threading.Lock()
-camera_instance = None
-camera_active = False
 STOP_EVENT = threading.Event()
-CAMERA_LOCK = threading.Lock()
-CAMERA_INSTANCE = None
-STREAM_ACTIVE = False
+
+# Реестр камер: серийный номер -> CameraPipeline
+CAMERAS = {}
+CAMERAS_LOCK = threading.Lock()
+# Читатели колец процессов захвата (capture_service.py) по имени кольца
+RING_CAMERAS = {}
+
+# Режимы получения кадров: опрос MV_CC_GetImageBuffer или колбэк SDK
+ACQUISITION_POLLING = "polling"
+ACQUISITION_CALLBACK = "callback"
+CALLBACK_QUEUE_SIZE = 4
+
+# Профили задержки: сколько узлов буфера держит SDK и в каком порядке их отдаёт
+LATENCY_DEFAULT = "default"
+LATENCY_LATEST_ONLY = "latest-only"
+LATENCY_BUFFERED = "buffered"
+LATEST_ONLY_NODE_NUM = 3
+
+# Пресеты захвата для превью: аппаратный ROI, биннинг, прореживание
+PRESET_FULL = "full"
+PRESET_ROI = "roi"
+PRESET_BINNING = "binning2x2"
+PRESET_DECIMATION = "decimation2x2"
+CAPTURE_PRESETS = {
+    PRESET_FULL: {"binning": 1, "decimation": 1, "roi": False},
+    PRESET_ROI: {"binning": 1, "decimation": 1, "roi": True},
+    PRESET_BINNING: {"binning": 2, "decimation": 1, "roi": False},
+    PRESET_DECIMATION: {"binning": 1, "decimation": 2, "roi": False},
+}
+
+# Параметры транспорта GigE Vision
+GEV_RESEND_ENABLE = True
+GEV_RESEND_MAX_PERCENT = 10        # Доля пакетов кадра, которую можно запросить повторно, %
+GEV_RESEND_TIMEOUT_MS = 50         # Ожидание повторно отправленного пакета
+GVCP_TIMEOUT_MS = 500              # Таймаут управляющей команды GVCP
+GVCP_RETRY_TIMES = 3               # Повторы управляющей команды GVCP
+
+# Переподключение после обрыва связи с камерой
+# Режим экспозиции: "auto" — автоэкспозиция камеры, "software" — ExposureController
+# (с целевой частотой кадров недостающую яркость добирает Gain)
+EXPOSURE_AUTO = "auto"
+EXPOSURE_SOFTWARE = "software"
+
+# Процессов JPEG-кодирования на камеру (0 — кодировать в потоке захвата)
+ENCODE_WORKERS = 0
+# Кодировщик JPEG: None — самый быстрый из установленных по замеру при открытии камеры
+JPEG_ENCODER = None
+
+# Адаптация /video_feed под канал клиента: ступени (качество JPEG, уменьшение кадра),
+# None — качество камеры. Клиент спускается на ступень, если задержка кадра выше границы,
+# и поднимается, когда она долго держится ниже половины границы.
+STREAM_LEVELS = ((None, 1), (60, 1), (45, 1), (60, 2), (45, 2), (35, 4))
+STREAM_LATENCY_BOUND = 0.5         # Допустимая задержка кадра у клиента, с
+STREAM_STEP_DOWN_HOLD = 0.5        # Не чаще одного понижения за этот интервал, с
+STREAM_STEP_UP_HOLD = 3.0          # Сколько задержка должна быть низкой перед повышением, с
+STREAM_EWMA = 0.2                  # Вес нового замера в сглаженных пропускной способности и задержке
+# Кадр, пришедший чуть раньше интервала клиента (?fps=), ещё считается нужным —
+# иначе неровный темп камеры вдвое урезал бы частоту
+FRAME_INTERVAL_TOLERANCE = 0.9
+# Столько ошибок обработки подряд — и камера переоткрывается супервизором
+CAPTURE_ERROR_LIMIT = 10
+
+RECONNECT_BACKOFF_MIN = 0.1        # Первая пауза между попытками, с
+RECONNECT_BACKOFF_MAX = 1.0        # Потолок паузы — камера подхватывается за ~1 с после появления
 
 SRT_FILENAME = None  # Будет хранить имя файла без расширения
 
-# Глобальные переменные для управления экспозицией
-TARGET_BRIGHTNESS = 60.0           # Целевая яркость (0-255)
-INITIAL_EXPOSURE = 30000.0         # Стартовая экспозиция (высокая для темноты)
-MIN_EXPOSURE = 20000.0             # Минимальная экспозиция (не даём опускаться ниже уровня для темноты)
-MAX_EXPOSURE = 100000.0            # Максимальная экспозиция
-SMOOTHING_FACTOR_UP = 0.05         # Плавность при увеличении экспозиции (для темноты)
-SMOOTHING_FACTOR_DOWN = 0.01       # Плавность при уменьшении (для света, очень медленно)
+# Поток отдаётся в JPEG одноканальным: без расширения 8-битного кадра до BGR
+STREAM_MONO = True
+
+# Представление чужой памяти как read-only memoryview без копирования
+PyBUF_READ = 0x100
+_PyMemoryView_FromMemory = pythonapi.PyMemoryView_FromMemory
+_PyMemoryView_FromMemory.argtypes = (c_void_p, c_ssize_t, c_int)
+_PyMemoryView_FromMemory.restype = py_object
+
+
+class GrabbedFrame:
+    """Кадр из внутреннего буфера SDK, доступный как numpy-массив без копирования.
+
+    Массив `image` смотрит прямо в память MV_FRAME_OUT и существует только внутри
+    блока `with`. На выходе буфер возвращается в SDK через MV_CC_FreeImageBuffer
+    ровно один раз — в том числе при исключении внутри блока. Если ссылка на кадр
+    (или его срез) пережила блок, буфер всё равно возвращается в SDK (иначе он
+    потерян для захвата навсегда), а затем выход из блока бросает RuntimeError:
+    унесённое представление видело бы уже переиспользованную память.
+    """
+
+    def __init__(self, cam, st_frame):
+        self._cam = cam
+        self._st_frame = st_frame
+        self._base = None
+        self._image = None
+        self._entered = False
+        self._released = False
+
+        info = st_frame.stFrameInfo
+        self.width = info.nWidth
+        self.height = info.nHeight
+        self.frame_num = info.nFrameNum
+        self.lost_packets = info.nLostPacket
+
+    def __enter__(self):
+        if self._released:
+            raise RuntimeError("Frame buffer already released")
+        info = self._st_frame.stFrameInfo
+        address = cast(self._st_frame.pBufAddr, c_void_p).value
+        memory = _PyMemoryView_FromMemory(address, info.nFrameLen, PyBUF_READ)
+        # Все производные представления numpy ссылаются на _base — по нему и
+        # проверяем, что никто не унёс кадр за пределы with
+        self._base = np.frombuffer(memory, dtype=np.uint8)
+        self._image = self._base.reshape((info.nHeight, info.nWidth))
+        self._entered = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # При исключении traceback ещё держит ссылки на кадр — проверка утечки дала бы ложное срабатывание
+        self.release(check_escape=exc_type is None)
+        return False
+
+    @property
+    def image(self):
+        if not self._entered or self._released:
+            raise RuntimeError("Frame image is only valid inside its 'with' block")
+        return self._image
+
+    def release(self, check_escape=True):
+        if self._released:
+            return
+        self._released = True
+        self._image = None
+        base, self._base = self._base, None
+        # 2 = локальная переменная + аргумент getrefcount
+        escaped = check_escape and base is not None and sys.getrefcount(base) > 2
+        del base
+        ret = self._cam.MV_CC_FreeImageBuffer(self._st_frame)
+        if ret != MV_OK:
+            print(f"Warning: Free Image Buffer fail! ret[0x{ret & 0xFFFFFFFF:x}]")
+        if escaped:
+            raise RuntimeError(f"Frame {self.frame_num} view escaped its 'with' block; copy it before leaving")
+
+
+def grab_frame(cam, timeout_ms=1000):
+    """Забирает кадр из SDK. Возвращает (код, GrabbedFrame или None)"""
+    st_frame = MV_FRAME_OUT()
+    memset(byref(st_frame), 0, sizeof(st_frame))
+
+    ret = cam.MV_CC_GetImageBuffer(st_frame, timeout_ms)
+    if ret != MV_OK:
+        return ret, None
+    if not st_frame.pBufAddr:
+        cam.MV_CC_FreeImageBuffer(st_frame)
+        return MV_E_NODATA, None
+    return ret, GrabbedFrame(cam, st_frame)
+
+
+class CopiedFrame:
+    """Кадр, уже скопированный в память Python. Тот же интерфейс, что у GrabbedFrame"""
+
+    def __init__(self, image, frame_num, lost_packets=0):
+        self.image = image
+        self.width = image.shape[1]
+        self.height = image.shape[0]
+        self.frame_num = frame_num
+        self.lost_packets = lost_packets
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class PollingFrameSource:
+    """Получение кадров опросом MV_CC_GetImageBuffer"""
+
+    mode = ACQUISITION_POLLING
+    dropped = 0
+
+    def __init__(self, cam):
+        self.cam = cam
+
+    def get(self, timeout_ms=1000):
+        return grab_frame(self.cam, timeout_ms)
+
+
+# C-прототип: void cbOutput(unsigned char* pData, MV_FRAME_OUT_INFO_EX* pFrameInfo, void* pUser)
+FrameInfoCallBack = CFUNCTYPE(None, POINTER(c_ubyte), POINTER(MV_FRAME_OUT_INFO_EX), c_void_p)
+
+
+class CallbackFrameSource:
+    """Получение кадров через MV_CC_RegisterImageCallBackEx.
+
+    Поток SDK копирует кадр и кладёт его в ограниченную очередь; при
+    переполнении выбрасывается самый старый кадр. Потребитель блокируется на
+    очереди и не крутится впустую, пока камера молчит. Регистрировать нужно
+    до MV_CC_StartGrabbing.
+    """
+
+    mode = ACQUISITION_CALLBACK
+
+    def __init__(self, cam, maxsize=CALLBACK_QUEUE_SIZE):
+        self.cam = cam
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        # Ссылку на колбэк держим, пока жив дескриптор камеры
+        self._callback = FrameInfoCallBack(self._on_frame)
+        ret = cam.MV_CC_RegisterImageCallBackEx(self._callback, None)
+        if ret != MV_OK:
+            raise RuntimeError(f"Failed to register image callback: 0x{ret & 0xFFFFFFFF:x}")
+
+    def _on_frame(self, pData, pFrameInfo, pUser):
+        info = pFrameInfo.contents
+        image = np.empty((info.nHeight, info.nWidth), dtype=np.uint8)
+        memmove(image.ctypes.data, pData, min(info.nFrameLen, image.nbytes))
+        item = (image, info.nFrameNum, info.nLostPacket)
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout_ms=1000):
+        try:
+            image, frame_num, lost_packets = self.queue.get(timeout=timeout_ms / 1000.0)
+        except queue.Empty:
+            return MV_E_NODATA, None
+        return MV_OK, CopiedFrame(image, frame_num, lost_packets)
+
+
+# C-прототип: void cbException(unsigned int nMsgType, void* pUser)
+ExceptionCallBack = CFUNCTYPE(None, c_uint, c_void_p)
+
+
+class StreamFrame:
+    """Кадр для раздачи: JPEG с настройками камеры, обработанное изображение
+    и варианты с другим качеством/размером, закодированные по запросу клиентов"""
+
+    def __init__(self, jpeg, image, captured, encoder):
+        self.seq = 0
+        self.jpeg = jpeg
+        self.image = image
+        self.captured = captured
+        self.encoder = encoder
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    @property
+    def width(self):
+        return self.image.shape[1]
+
+    def variant(self, quality=None, width=None, encode=True):
+        """JPEG с качеством quality и шириной width (с сохранением пропорций).
+
+        Одинаковые варианты кодируются один раз и достаются всем клиентам с
+        такими же настройками. encode=False — только готовый вариант или None,
+        без кодирования и без ожидания блокировки (для event loop).
+        """
+        settings = self.encoder.settings
+        if quality == settings.quality:
+            quality = None
+        if width is not None and width >= self.width:
+            width = None
+        if quality is None and width is None:
+            return self.jpeg
+        key = (quality, width)
+        if not encode:
+            return self._variants.get(key)
+        with self._lock:
+            jpeg = self._variants.get(key)
+            if jpeg is None:
+                image = self.image
+                if width is not None:
+                    height = max(round(image.shape[0] * width / image.shape[1]), 1)
+                    image = cv2.resize(image, (max(width, 1), height), interpolation=cv2.INTER_AREA)
+                encoder = make_encoder(self.encoder.name, JpegSettings(quality or settings.quality, settings.subsampling,
+                                                                       settings.progressive, settings.optimize))
+                jpeg = self._variants[key] = encoder.encode(image)
+        return jpeg
+
+
+class ClientStream:
+    """Один зритель /video_feed: замер канала и выбор ступени качества.
+
+    Время отправки — сколько генератор простоял на yield, пока сервер писал
+    часть в сокет; задержка — от захвата кадра до конца его отправки.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, remote_addr, max_latency=STREAM_LATENCY_BOUND, fps=None, width=None):
+        self.client_id = next(self._ids)
+        self.remote_addr = remote_addr
+        self.max_latency = max_latency
+        self.fps = fps
+        self.width = width
+        self.level = 0
+        self.frames = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.throttled = 0
+        self.throughput = 0.0
+        self.latency = 0.0
+        self.connected = time.monotonic()
+        self._last_seq = None
+        self._last_captured = None
+        self._last_change = self.connected
+        self._low_since = None
+
+    @property
+    def frame_interval(self):
+        """Минимальный интервал между кадрами клиента, с (0 — без ограничения)"""
+        return 1.0 / self.fps if self.fps else 0.0
+
+    def wants(self, frame):
+        """Нужен ли кадр клиенту с ограничением частоты; лишние пропускаем до кодирования"""
+        if self._last_captured is not None and \
+                frame.captured - self._last_captured < self.frame_interval * FRAME_INTERVAL_TOLERANCE:
+            self.throttled += 1
+            self._last_seq = frame.seq
+            return False
+        self._last_captured = frame.captured
+        return True
+
+    def frame_bytes(self, frame, encode=True):
+        quality, scale = STREAM_LEVELS[self.level]
+        width = (self.width or frame.width) // scale
+        return frame.variant(quality, width, encode)
+
+    def sent(self, frame, nbytes, send_time):
+        now = time.monotonic()
+        if self._last_seq is not None:
+            self.skipped += max(frame.seq - self._last_seq - 1, 0)
+        self._last_seq = frame.seq
+        self.frames += 1
+        self.bytes += nbytes
+        if send_time > 0:
+            self.throughput += STREAM_EWMA * (nbytes / send_time - self.throughput)
+        self.latency += STREAM_EWMA * (now - frame.captured - self.latency)
+
+        if self.latency > self.max_latency:
+            self._low_since = None
+            if self.level < len(STREAM_LEVELS) - 1 and now - self._last_change >= STREAM_STEP_DOWN_HOLD:
+                self.level += 1
+                self._last_change = now
+        elif self.latency < self.max_latency / 2:
+            if self._low_since is None:
+                self._low_since = now
+            if self.level > 0 and now - max(self._low_since, self._last_change) >= STREAM_STEP_UP_HOLD:
+                self.level -= 1
+                self._last_change = now
+        else:
+            self._low_since = None
+
+    def status(self):
+        quality, scale = STREAM_LEVELS[self.level]
+        return {
+            "client_id": self.client_id,
+            "remote_addr": self.remote_addr,
+            "level": self.level,
+            "quality": quality,
+            "scale": scale,
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "throttled": self.throttled,
+            "fps_limit": self.fps,
+            "width_limit": self.width,
+            "bytes": self.bytes,
+            "bandwidth_kbps": round(self.throughput * 8 / 1000.0, 1),
+            "latency_ms": round(self.latency * 1000.0, 1),
+            "max_latency_ms": round(self.max_latency * 1000.0, 1),
+            "connected_s": round(time.monotonic() - self.connected, 1)
+        }
+
+
+class ClientRegistry:
+    """Зрители /video_feed одной камеры в этом процессе (self.clients под self.clients_lock)"""
+
+    def add_client(self, remote_addr, max_latency=STREAM_LATENCY_BOUND, fps=None, width=None):
+        client = ClientStream(remote_addr, max_latency, fps, width)
+        with self.clients_lock:
+            self.clients[client.client_id] = client
+        return client
+
+    def remove_client(self, client):
+        with self.clients_lock:
+            self.clients.pop(client.client_id, None)
+
+    @property
+    def viewers(self):
+        with self.clients_lock:
+            return len(self.clients)
+
+    def frame_interval(self):
+        """Как часто нужны кадры самому быстрому зрителю, с (0 — каждый кадр)"""
+        with self.clients_lock:
+            if not self.clients:
+                return 0.0
+            return min(client.frame_interval for client in self.clients.values())
+
+    def client_stats(self):
+        with self.clients_lock:
+            clients = list(self.clients.values())
+        return [client.status() for client in clients]
+
+
+class FrameBroadcaster:
+    """Раздаёт последний обработанный кадр всем зрителям /video_feed.
+
+    Хранится только самый свежий кадр (StreamFrame) с порядковым номером. У каждого
+    подписчика свой курсор (номер последнего отданного кадра): медленный клиент
+    просто перескакивает на новейший кадр и никогда не тормозит захват.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._frame = None
+        self._closed = True
+        self._subscribers = 0
+        self._listeners = []
+        # Отличает номера кадров этого экземпляра от прежних (для ETag снимков)
+        self.epoch = time.time_ns()
+
+    @property
+    def subscribers(self):
+        return self._subscribers
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def open(self):
+        with self._cond:
+            self._closed = False
+            self._frame = None
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(None)
+
+    def publish(self, frame):
+        with self._cond:
+            self._seq += 1
+            frame.seq = self._seq
+            self._frame = frame
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(frame)
+
+    def add_listener(self, listener):
+        """listener(frame) вызывается в потоке захвата на каждый кадр и listener(None) при
+        остановке — так кадры получают не потоки, а, например, корутины ASGI-сервера"""
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def latest(self):
+        """Последний опубликованный кадр или None — без ожидания и без обращения к камере"""
+        with self._cond:
+            return self._frame
+
+    def subscribe(self):
+        """Генератор кадров для одного зрителя; завершается при остановке захвата"""
+        cursor = 0
+        with self._cond:
+            self._subscribers += 1
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed or (self._seq != cursor and self._frame is not None))
+                    if self._closed:
+                        return
+                    cursor, frame = self._seq, self._frame
+                yield frame
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+
+class CaptureThread(threading.Thread):
+    """Единственный цикл захвата: один grab и один прогон этапов обработки
+    (ProcessingPipeline) на кадр независимо от числа зрителей"""
+
+    def __init__(self, pipeline, lost_packets=0):
+        threading.Thread.__init__(self, daemon=True, name=f"capture-{pipeline.camera_id}")
+        self.source = pipeline.source
+        self.broadcaster = pipeline.broadcaster
+        self.processing = pipeline.processing
+        self.frame_interval = pipeline.frame_interval
+        self.on_link_lost = pipeline.link_lost
+        self.stop_event = threading.Event()
+        self.running = False
+        self.fps = 0.0
+        self.lost_packets = lost_packets
+        self.throttled = 0
+        self.errors = 0
+
+    def run(self):
+        self.running = True
+        frame_count = 0
+        start_time = time.time()
+        last_processed = None
+        consecutive_errors = 0
+        try:
+            while not self.stop_event.is_set():
+                ret, grabbed = self.source.get(1000)
+                # restype MV_CC_GetImageBuffer — c_uint: коды ошибок SDK сравниваем без знака.
+                # Нет кадра за таймаут (триггер, медленный пресет) — не обрыв связи
+                if ret & 0xFFFFFFFF == MV_E_NODATA:
+                    continue
+                elif ret != MV_OK:
+                    print(f"Capture error: 0x{ret & 0xFFFFFFFF:x}")
+                    self.on_link_lost()
+                    break
+
+                self.lost_packets += grabbed.lost_packets
+                captured = time.monotonic()
+
+                # Частота кадров камеры (для сравнения режимов захвата) — по всем полученным кадрам
+                frame_count += 1
+                elapsed = time.time() - start_time
+                if elapsed >= 1.0:
+                    self.fps = frame_count / elapsed
+                    frame_count = 0
+                    start_time = time.time()
+
+                # Кадр не нужен ни одному зрителю (все ограничили ?fps=) — только замер и денойзер,
+                # чтобы экспозиция и усреднение шли на частоте камеры, а не самого быстрого зрителя
+                interval = self.frame_interval()
+                output = not (interval and last_processed is not None and
+                              captured - last_processed < interval * FRAME_INTERVAL_TOLERANCE)
+                if output:
+                    last_processed = captured
+                else:
+                    self.throttled += 1
+                try:
+                    with grabbed:
+                        if output:
+                            # JPEG уходит зрителям из run() или, с пулом кодировщиков, из его сборщика по порядку
+                            self.processing.run(grabbed.image, lambda jpeg, image, captured=captured: self.publish(
+                                jpeg, image, captured))
+                        else:
+                            self.processing.run(grabbed.image, output=False)
+                    consecutive_errors = 0
+                except Exception as e:
+                    # Ошибка одного кадра не должна останавливать захват, а зрители — ждать вечно
+                    self.errors += 1
+                    consecutive_errors += 1
+                    print(f"Processing error on frame {grabbed.frame_num}: {e!r}")
+                    if consecutive_errors >= CAPTURE_ERROR_LIMIT:
+                        print(f"Capture: {consecutive_errors} processing errors in a row, reopening camera")
+                        self.on_link_lost()
+                        break
+        except Exception as e:
+            # Сбой вне обработки кадра (источник кадров, SDK): пусть супервизор переоткроет камеру
+            print(f"Capture thread failed: {e!r}")
+            self.on_link_lost()
+        finally:
+            self.running = False
+
+    def publish(self, jpeg, image, captured):
+        self.broadcaster.publish(StreamFrame(jpeg, image, captured, self.processing.encoder))
 
-# Глобальные переменные
-current_exposure = INITIAL_EXPOSURE
 
 class Point(BaseModel):
     lat: float
@@ -66,74 +633,755 @@ def serve_index():
 def serve_static(path):
     return send_from_directory('.', path)
 
-def init_camera():
-    global camera_instance, camera_active
+GRAB_STRATEGY_NAMES = {
+    MV_GrabStrategy_OneByOne: "OneByOne",
+    MV_GrabStrategy_LatestImagesOnly: "LatestImagesOnly",
+    MV_GrabStrategy_LatestImages: "LatestImages",
+    MV_GrabStrategy_UpcomingImage: "UpcomingImage",
+}
 
-    with camera_lock:
-        if camera_instance is not None:
-            return camera_instance
 
-        try:
-            # 1. Поиск устройств
-            device_list = MV_CC_DEVICE_INFO_LIST()
-            ret = MvCamera.MV_CC_EnumDevices(MV_GIGE_DEVICE, device_list)
-            if ret != MV_OK or device_list.nDeviceNum == 0:
-                raise RuntimeError("No cameras found")
-
-            # 2. Создание объекта камеры
-            cam = MvCamera()
-            device_info = MV_CC_DEVICE_INFO()
-            pointer_device_info = pointer(device_info)
-            memmove(pointer_device_info, device_list.pDeviceInfo[0], sizeof(device_info))
-
-            # 3. Создание дескриптора
-            handle = c_void_p()
-            ret = MvCamCtrldll.MV_CC_CreateHandle(byref(handle), byref(device_info))
-            if ret != MV_OK:
-                raise RuntimeError("Failed to create camera handle")
+def parse_latency_profile(value):
+    """'default', 'latest-only' или 'buffered-N' -> (профиль, N)"""
+    value = (value or LATENCY_DEFAULT).strip().lower()
+    if value in (LATENCY_DEFAULT, LATENCY_LATEST_ONLY):
+        return value, None
+    match = re.fullmatch(r'buffered[-_ :]?(\d+)', value)
+    if match and int(match.group(1)) >= 1:
+        return LATENCY_BUFFERED, int(match.group(1))
+    raise ValueError(f"Unknown latency profile: {value}")
 
-            cam.handle = handle
 
-            # 4. Подключение к камере
-            ret = cam.MV_CC_OpenDevice()
-            if ret != MV_OK:
-                raise RuntimeError("Failed to open camera")
+def apply_latency_profile(cam, profile, buffers=None):
+    """Настраивает буферы SDK до старта захвата и возвращает то, что реально применилось.
 
-            # 5. Настройка параметров
-            cam.MV_CC_SetEnumValue("PixelFormat", PixelType_Gvsp_Mono8)
-            cam.MV_CC_SetEnumValue("ExposureAuto", MV_EXPOSURE_AUTO_MODE_CONTINUOUS)
-            cam.MV_CC_SetFloatValue("TargetBrightness", 60.0)
+    latest-only — SDK держит несколько узлов, но отдаёт только самый свежий кадр,
+    остальные выбрасывает; buffered-N — последние N кадров по порядку.
+    Стратегия действует только при активном получении (MV_CC_GetImageBuffer).
+    """
+    settings = {"profile": profile}
+    if profile == LATENCY_DEFAULT:
+        return settings
+
+    if profile == LATENCY_LATEST_ONLY:
+        node_num, strategy, output_queue = LATEST_ONLY_NODE_NUM, MV_GrabStrategy_LatestImagesOnly, None
+    else:
+        node_num, strategy, output_queue = buffers, MV_GrabStrategy_LatestImages, buffers
+        settings["profile"] = f"{LATENCY_BUFFERED}-{buffers}"
+
+    errors = {}
+    ret = cam.MV_CC_SetImageNodeNum(node_num)
+    settings["image_node_num"] = node_num if ret == MV_OK else None
+    if ret != MV_OK:
+        errors["image_node_num"] = f"0x{ret & 0xFFFFFFFF:x}"
+
+    ret = cam.MV_CC_SetGrabStrategy(strategy)
+    settings["grab_strategy"] = GRAB_STRATEGY_NAMES[strategy] if ret == MV_OK else None
+    if ret != MV_OK:
+        errors["grab_strategy"] = f"0x{ret & 0xFFFFFFFF:x}"
+
+    if output_queue is not None:
+        ret = cam.MV_CC_SetOutputQueueSize(output_queue)
+        settings["output_queue_size"] = output_queue if ret == MV_OK else None
+        if ret != MV_OK:
+            errors["output_queue_size"] = f"0x{ret & 0xFFFFFFFF:x}"
+
+    if errors:
+        settings["errors"] = errors
+    return settings
+
+
+def get_int_node(cam, key):
+    """MVCC_INTVALUE узла или None, если узел недоступен"""
+    st_param = MVCC_INTVALUE()
+    memset(byref(st_param), 0, sizeof(st_param))
+    if cam.MV_CC_GetIntValue(key, st_param) != MV_OK:
+        return None
+    return st_param
+
+
+def set_int_node_aligned(cam, key, value):
+    """Записывает целочисленный узел с учётом min/max/шага; возвращает записанное значение"""
+    node = get_int_node(cam, key)
+    if node is None:
+        return None
+    inc = max(node.nInc, 1)
+    value = min(max(int(value), node.nMin), node.nMax)
+    value = node.nMin + (value - node.nMin) // inc * inc
+    if cam.MV_CC_SetIntValue(key, value) != MV_OK:
+        return None
+    return value
+
+
+def set_factor_node(cam, key, factor):
+    """Биннинг/прореживание: на одних моделях это enum, на других integer"""
+    if cam.MV_CC_SetEnumValue(key, factor) == MV_OK or cam.MV_CC_SetIntValue(key, factor) == MV_OK:
+        return factor
+    return None
+
+
+def parse_roi(args):
+    """ROI из параметров запроса (width, height, offset_x, offset_y); отсутствующие — None"""
+    roi = {}
+    for key in ("width", "height", "offset_x", "offset_y"):
+        value = args.get(key)
+        roi[key] = int(value) if value not in (None, "") else None
+    return roi
+
+
+def apply_capture_preset(cam, preset, roi=None):
+    """Применяет пресет захвата; вызывать только при остановленном захвате.
+
+    Биннинг и прореживание выставляются первыми — от них зависят WidthMax/HeightMax.
+    ROI без явных размеров — центральная половина кадра по каждой оси.
+    Возвращает фактические значения узлов камеры.
+    """
+    if preset not in CAPTURE_PRESETS:
+        raise ValueError(f"Unknown capture preset: {preset}")
+    params = CAPTURE_PRESETS[preset]
+    roi = roi or {}
+    settings = {"preset": preset}
+
+    settings["binning"] = set_factor_node(cam, "BinningHorizontal", params["binning"])
+    set_factor_node(cam, "BinningVertical", params["binning"])
+    settings["decimation"] = set_factor_node(cam, "DecimationHorizontal", params["decimation"])
+    set_factor_node(cam, "DecimationVertical", params["decimation"])
+
+    # Смещения в ноль, иначе ширину/высоту нельзя увеличить до максимума
+    cam.MV_CC_SetIntValue("OffsetX", 0)
+    cam.MV_CC_SetIntValue("OffsetY", 0)
+    width_max = get_int_node(cam, "WidthMax")
+    height_max = get_int_node(cam, "HeightMax")
+    if width_max is None or height_max is None:
+        raise RuntimeError("Camera does not report WidthMax/HeightMax")
+    full_width, full_height = width_max.nCurValue, height_max.nCurValue
+
+    if params["roi"]:
+        width = roi.get("width") or full_width // 2
+        height = roi.get("height") or full_height // 2
+        settings["width"] = set_int_node_aligned(cam, "Width", width)
+        settings["height"] = set_int_node_aligned(cam, "Height", height)
+        offset_x = roi.get("offset_x")
+        offset_y = roi.get("offset_y")
+        if offset_x is None:
+            offset_x = (full_width - (settings["width"] or full_width)) // 2
+        if offset_y is None:
+            offset_y = (full_height - (settings["height"] or full_height)) // 2
+        settings["offset_x"] = set_int_node_aligned(cam, "OffsetX", offset_x)
+        settings["offset_y"] = set_int_node_aligned(cam, "OffsetY", offset_y)
+    else:
+        settings["width"] = set_int_node_aligned(cam, "Width", full_width)
+        settings["height"] = set_int_node_aligned(cam, "Height", full_height)
+        settings["offset_x"] = settings["offset_y"] = 0
+
+    return settings
+
+
+def tune_transport(cam):
+    """Настройка GigE-транспорта при открытии камеры; возвращает применённые значения"""
+    settings = {}
+
+    # Оптимальный размер пакета (учитывает jumbo frames на сетевой карте)
+    packet_size = cam.MV_CC_GetOptimalPacketSize()
+    if 0 < packet_size <= 0xFFFF:
+        ret = cam.MV_CC_SetIntValue("GevSCPSPacketSize", packet_size)
+        if ret != MV_OK:
+            print(f"Warning: Set Packet Size fail! ret[0x{ret & 0xFFFFFFFF:x}]")
+    else:
+        print(f"Warning: Get Packet Size fail! ret[0x{packet_size & 0xFFFFFFFF:x}]")
+    st_param = MVCC_INTVALUE()
+    memset(byref(st_param), 0, sizeof(st_param))
+    if cam.MV_CC_GetIntValue("GevSCPSPacketSize", st_param) == MV_OK:
+        settings["packet_size"] = st_param.nCurValue
+
+    ret = cam.MV_GIGE_SetResend(int(GEV_RESEND_ENABLE), GEV_RESEND_MAX_PERCENT, GEV_RESEND_TIMEOUT_MS)
+    if ret == MV_OK:
+        settings["resend"] = {
+            "enabled": GEV_RESEND_ENABLE,
+            "max_percent": GEV_RESEND_MAX_PERCENT,
+            "timeout_ms": GEV_RESEND_TIMEOUT_MS
+        }
+    else:
+        print(f"Warning: Set Resend fail! ret[0x{ret & 0xFFFFFFFF:x}]")
+
+    cam.MV_GIGE_SetGvcpTimeout(GVCP_TIMEOUT_MS)
+    cam.MV_GIGE_SetRetryGvcpTimes(GVCP_RETRY_TIMES)
+    gvcp_timeout = c_uint(0)
+    if cam.MV_GIGE_GetGvcpTimeout(gvcp_timeout) == MV_OK:
+        settings["gvcp_timeout_ms"] = gvcp_timeout.value
+    gvcp_retry = c_uint(0)
+    if cam.MV_GIGE_GetRetryGvcpTimes(gvcp_retry) == MV_OK:
+        settings["gvcp_retry_times"] = gvcp_retry.value
+
+    return settings
+
+
+def read_transport_stats(cam, prev=None):
+    """Статистика приёма по MV_GIGE_GetNetTransInfo и скорость с прошлого замера.
+
+    prev — (время, принято байт) предыдущего замера; возвращает (статистика, новый замер).
+    """
+    info = MV_NETTRANS_INFO()
+    memset(byref(info), 0, sizeof(info))
+    ret = cam.MV_GIGE_GetNetTransInfo(info)
+    if ret != MV_OK:
+        raise RuntimeError(f"Failed to read transport info: 0x{ret & 0xFFFFFFFF:x}")
+
+    now = time.time()
+    bytes_per_second = None
+    if prev is not None and now > prev[0] and info.nReceiveDataSize >= prev[1]:
+        bytes_per_second = (info.nReceiveDataSize - prev[1]) / (now - prev[0])
+
+    return {
+        "received_bytes": info.nReceiveDataSize,
+        "bytes_per_second": bytes_per_second,
+        "received_frames": info.nNetRecvFrameCount,
+        "thrown_frames": info.nThrowFrameCount,
+        "resend_requested": info.nRequestResendPacketCount,
+        "resent_packets": info.nResendPacketCount
+    }, (now, info.nReceiveDataSize)
+
+
+def decode_device_string(chars):
+    """Строка из массива c_ubyte в описании устройства (до первого нуля)"""
+    return bytes(chars).split(b'\x00', 1)[0].decode('ascii', errors='ignore').strip()
+
+
+def enumerate_cameras():
+    """Список GigE-камер: [(серийный номер, пользовательское имя, MV_CC_DEVICE_INFO)]"""
+    device_list = MV_CC_DEVICE_INFO_LIST()
+    ret = MvCamera.MV_CC_EnumDevices(MV_GIGE_DEVICE, device_list)
+    if ret != MV_OK:
+        raise RuntimeError(f"Enum devices fail! ret[0x{ret & 0xFFFFFFFF:x}]")
+
+    cameras = []
+    for i in range(device_list.nDeviceNum):
+        device_info = MV_CC_DEVICE_INFO()
+        memmove(byref(device_info), device_list.pDeviceInfo[i], sizeof(device_info))
+        gige_info = device_info.SpecialInfo.stGigEInfo
+        cameras.append((decode_device_string(gige_info.chSerialNumber),
+                        decode_device_string(gige_info.chUserDefinedName),
+                        device_info))
+    return cameras
+
+
+def find_camera_device(camera_id=None):
+    """Ищет камеру по серийному номеру или пользовательскому имени; без id — первая найденная"""
+    cameras = enumerate_cameras()
+    if not cameras:
+        raise RuntimeError("No cameras found")
+    if camera_id is None:
+        return cameras[0]
+    for serial, name, device_info in cameras:
+        if camera_id in (serial, name):
+            return serial, name, device_info
+    raise RuntimeError(f"Camera not found: {camera_id}")
+
+
+class CameraPipeline(ClientRegistry):
+    """Одна камера со своим дескриптором SDK, потоком захвата, раздачей кадров
+    и состоянием экспозиции. Старт/стоп защищены собственной блокировкой,
+    так что камеры не ждут друг друга.
+
+    После start_capture() за камерой следит поток-супервизор: обрыв приходит
+    через MV_CC_RegisterExceptionCallBack (или ошибку захвата), после чего
+    камера переоткрывается с экспоненциальной паузой и прежними настройками.
+    Раздача кадров при этом не закрывается — зрители просто получают
+    следующий кадр после восстановления связи.
+    """
 
-            # 6. Запуск захвата
-            ret = cam.MV_CC_StartGrabbing()
-            if ret != MV_OK:
-                raise RuntimeError("Failed to start grabbing")
+    def __init__(self, serial, name, device_info):
+        self.camera_id = serial
+        self.serial = serial
+        self.name = name
+        self.device_info = device_info
+        self.lock = threading.Lock()
+        self.cam = None
+        self.source = None
+        self.capture_thread = None
+        self.broadcaster = FrameBroadcaster()
+        self.exposure = ExposureController()
+        self.meter = Meter()
+        self.denoiser = TemporalDenoiser()
+        self.processing = ProcessingPipeline(self.exposure, self.meter, self.denoiser, mono=STREAM_MONO,
+                                             encoder=make_encoder())
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        self.encoder_settings = {"name": JPEG_ENCODER, "jpeg": JpegSettings()}
+        self.encode_pool = None
+        if ENCODE_WORKERS:
+            self.set_encode_workers(ENCODE_WORKERS)
+        self.latency_settings = {"profile": LATENCY_DEFAULT}
+        self.transport_settings = {}
+        self.net_stats_prev = None
+        self.preset_settings = {"preset": None}
+        # Режим экспозиции переживает переподключение: open() применяет его заново
+        self.exposure_settings = {"mode": EXPOSURE_AUTO, "target_fps": None, "readout_us": None}
+        # Последняя конфигурация — её же применяем при переподключении
+        self.config = {
+            "acquisition": ACQUISITION_POLLING,
+            "latency": LATENCY_DEFAULT,
+            "buffers": None,
+            "preset": None,
+            "roi": None
+        }
+
+        self.supervisor = None
+        self.reconnects = 0
+        self._link_lost = threading.Event()
+        self._closing = threading.Event()
+        # Ссылку на колбэк держим, пока жив дескриптор камеры
+        self._exception_callback = ExceptionCallBack(self._on_exception)
+
+    @property
+    def active(self):
+        return self.capture_thread is not None and self.capture_thread.running
+
+    @property
+    def reconnecting(self):
+        return self._link_lost.is_set() and not self._closing.is_set()
+
+    def _on_exception(self, msg_type, pUser):
+        # Поток SDK: только выставляем флаг, всё остальное делает супервизор
+        if msg_type == MV_EXCEPTION_DEV_DISCONNECT:
+            self.link_lost()
+
+    def link_lost(self):
+        self._link_lost.set()
+
+    def open(self, acquisition=ACQUISITION_POLLING, latency=LATENCY_DEFAULT, buffers=None, preset=None, roi=None):
+        with self.lock:
+            if self.cam is not None:
+                return
+            self.config = {
+                "acquisition": acquisition,
+                "latency": latency,
+                "buffers": buffers,
+                "preset": preset,
+                "roi": roi
+            }
 
-            camera_instance = cam
-            camera_active = True
-            return cam
+            try:
+                # 1. Создание объекта камеры и дескриптора
+                cam = MvCamera()
+                handle = c_void_p()
+                ret = MvCamCtrldll.MV_CC_CreateHandle(byref(handle), byref(self.device_info))
+                if ret != MV_OK:
+                    raise RuntimeError("Failed to create camera handle")
+                cam.handle = handle
+                self.cam = cam
+
+                # 2. Подключение к камере
+                ret = cam.MV_CC_OpenDevice()
+                if ret != MV_OK:
+                    raise RuntimeError("Failed to open camera")
+
+                # 3. Настройка транспорта и параметров
+                self.transport_settings = tune_transport(cam)
+                self.net_stats_prev = None
+                cam.MV_CC_SetEnumValue("PixelFormat", PixelType_Gvsp_Mono8)
+                self._apply_exposure_mode(cam)
+                if preset is not None:
+                    self.preset_settings = apply_capture_preset(cam, preset, roi)
+
+                # 4. Буферы и стратегия выдачи кадров SDK
+                self.latency_settings = apply_latency_profile(cam, latency, buffers)
+                self._select_encoder(cam)
+
+                # 5. Источник кадров (колбэк регистрируется до старта захвата)
+                if acquisition == ACQUISITION_CALLBACK:
+                    self.source = CallbackFrameSource(cam)
+                else:
+                    self.source = PollingFrameSource(cam)
+
+                # 6. Уведомление об обрыве связи
+                ret = cam.MV_CC_RegisterExceptionCallBack(self._exception_callback, None)
+                if ret != MV_OK:
+                    print(f"Warning: exception callback fail! ret[0x{ret & 0xFFFFFFFF:x}]")
+
+                # 7. Запуск захвата
+                ret = cam.MV_CC_StartGrabbing()
+                if ret != MV_OK:
+                    raise RuntimeError("Failed to start grabbing")
+
+            except Exception:
+                self._release()
+                raise
+
+    def start_capture(self):
+        with self.lock:
+            if self.cam is None:
+                raise RuntimeError("Camera is not open")
+            # Открываем заранее, чтобы зритель, пришедший до первого кадра, не отвалился
+            self.broadcaster.open()
+            self._start_capture_thread()
+            if self.supervisor is None:
+                self._closing.clear()
+                self.supervisor = threading.Thread(target=self._supervise, daemon=True,
+                                                   name=f"supervisor-{self.camera_id}")
+                self.supervisor.start()
+
+    def close(self):
+        self._closing.set()
+        self._link_lost.set()
+        supervisor = self.supervisor
+        if supervisor is not None and supervisor is not threading.current_thread():
+            supervisor.join(timeout=5)
+        with self.lock:
+            self.supervisor = None
+            self._stop_capture_thread()
+            self._release()
+        self._link_lost.clear()
+        self.broadcaster.close()
+        self.set_encode_workers(0)
+
+    def set_preset(self, preset, roi=None):
+        """Переключает пресет на ходу: ROI и биннинг меняются только при остановленном захвате"""
+        if preset not in CAPTURE_PRESETS:
+            raise ValueError(f"Unknown capture preset: {preset}")
+        with self.lock:
+            if self.cam is None:
+                raise RuntimeError("Camera is not open")
+            restart = self.capture_thread is not None and self.capture_thread.is_alive()
+            self._stop_capture_thread()
+            self.cam.MV_CC_StopGrabbing()
+            try:
+                self.preset_settings = apply_capture_preset(self.cam, preset, roi)
+                self.config["preset"] = preset
+                self.config["roi"] = roi
+                self._select_encoder(self.cam)
+            finally:
+                ret = self.cam.MV_CC_StartGrabbing()
+                if ret != MV_OK:
+                    self.link_lost()
+                elif restart:
+                    self._start_capture_thread()
+            return self.preset_settings
+
+    def set_exposure_mode(self, mode, target_fps=None, readout_us=None):
+        """Переключает автоэкспозицию камеры / программную с целевой частотой кадров"""
+        if mode not in (EXPOSURE_AUTO, EXPOSURE_SOFTWARE):
+            raise ValueError(f"Unknown exposure mode: {mode}")
+        if target_fps is not None and target_fps <= 0:
+            raise ValueError("Target fps must be positive")
+        with self.lock:
+            self.exposure_settings = {"mode": mode, "target_fps": target_fps, "readout_us": readout_us}
+            if self.cam is not None:
+                self._apply_exposure_mode(self.cam)
+            return self.exposure_settings
+
+    def _apply_exposure_mode(self, cam):
+        settings = self.exposure_settings
+        self.exposure.configure(settings["target_fps"], settings["readout_us"])
+        if not settings["target_fps"]:
+            self._clear_fps_limits(cam)
+        if settings["mode"] == EXPOSURE_SOFTWARE:
+            cam.MV_CC_SetEnumValue("ExposureAuto", MV_EXPOSURE_AUTO_MODE_OFF)  # Отключаем автоэкспозицию!
+            write_gain = None
+            if settings["target_fps"]:
+                cam.MV_CC_SetEnumValue("GainAuto", MV_GAIN_MODE_OFF)
+                write_gain = lambda value: cam.MV_CC_SetFloatValue("Gain", value)
+            # Экспозицию пишет поток контроллера, цикл кадров только отдаёт замеры яркости
+            self.exposure.start(lambda value: cam.MV_CC_SetFloatValue("ExposureTime", value), write_gain)
+            return
 
+        self.exposure.stop()
+        cam.MV_CC_SetEnumValue("ExposureAuto", MV_EXPOSURE_AUTO_MODE_CONTINUOUS)
+        cam.MV_CC_SetFloatValue("TargetBrightness", 60.0)
+        if settings["target_fps"]:
+            # Автоэкспозиция камеры с тем же потолком выдержки, остальное — автоусиление
+            ret = cam.MV_CC_SetIntValue("AutoExposureTimeUpperLimit", int(self.exposure.exposure_limit()))
+            if ret != MV_OK:
+                print(f"Warning: set AutoExposureTimeUpperLimit fail! ret[0x{ret & 0xFFFFFFFF:x}]")
+            cam.MV_CC_SetEnumValue("GainAuto", MV_GAIN_MODE_CONTINUOUS)
+
+    def _clear_fps_limits(self, cam):
+        """Без целевой частоты кадров — снимает то, что выставил режим с ней: усиление
+        (программное или GainAuto) и потолок выдержки автоэкспозиции"""
+        cam.MV_CC_SetEnumValue("GainAuto", MV_GAIN_MODE_OFF)
+        ret = cam.MV_CC_SetFloatValue("Gain", 0.0)
+        if ret != MV_OK:
+            print(f"Warning: set Gain fail! ret[0x{ret & 0xFFFFFFFF:x}]")
+        limit = get_int_node(cam, "AutoExposureTimeUpperLimit")
+        if limit is not None and limit.nCurValue != limit.nMax:
+            ret = cam.MV_CC_SetIntValue("AutoExposureTimeUpperLimit", limit.nMax)
+            if ret != MV_OK:
+                print(f"Warning: set AutoExposureTimeUpperLimit fail! ret[0x{ret & 0xFFFFFFFF:x}]")
+
+    def set_encoder(self, name=None, jpeg=None):
+        """Кодировщик JPEG и его параметры; name=None — выбор по замеру скорости"""
+        if name is not None and name not in available_encoders():
+            raise ValueError(f"JPEG encoder is not available: {name}")
+        with self.lock:
+            self.encoder_settings = {"name": name, "jpeg": jpeg or self.encoder_settings["jpeg"]}
+            if self.cam is not None:
+                self._select_encoder(self.cam)
+            else:
+                self._set_encoder(make_encoder(name or ENCODER_OPENCV, self.encoder_settings["jpeg"]))
+            return self.processing.encoder.name
+
+    def _select_encoder(self, cam):
+        name, jpeg = self.encoder_settings["name"], self.encoder_settings["jpeg"]
+        if name is not None:
+            self._set_encoder(make_encoder(name, jpeg))
+            return
+        # Замер на кадре того размера, который будет отдавать камера
+        width, height = get_int_node(cam, "Width"), get_int_node(cam, "Height")
+        if width is None or height is None:
+            self._set_encoder(make_encoder(settings=jpeg))
+            return
+        shape = (height.nCurValue, width.nCurValue) if STREAM_MONO else (height.nCurValue, width.nCurValue, 3)
+        self._set_encoder(select_encoder(shape, jpeg))
+
+    def max_frame_shape(self):
+        """Форма самого крупного обработанного кадра при любом пресете (полная матрица без биннинга)
+        или None, если камера не сообщает размер"""
+        with self.lock:
+            if self.cam is None:
+                return None
+            for width_key, height_key in (("SensorWidth", "SensorHeight"), ("WidthMax", "HeightMax")):
+                width, height = get_int_node(self.cam, width_key), get_int_node(self.cam, height_key)
+                if width is not None and height is not None:
+                    # Поворот на 90° меняет местами стороны, но не объём кадра
+                    shape = (height.nCurValue, width.nCurValue)
+                    return shape if STREAM_MONO else shape + (3,)
+        return None
+
+    def _set_encoder(self, encoder):
+        self.processing.encoder = encoder
+        if self.encode_pool is not None:
+            self.encode_pool.set_encoder(encoder)
+
+    def set_encode_workers(self, workers):
+        """Пул процессов JPEG-кодирования; 0 — кодирование в потоке захвата"""
+        if workers < 0:
+            raise ValueError("Encoder worker count must not be negative")
+        with self.lock:
+            old_pool = self.encode_pool
+            self.encode_pool = EncoderPool(workers, self.processing.encoder) if workers else None
+            # Поток захвата подхватит новый пул со следующего кадра; close() дождётся submit(),
+            # который поток захвата, возможно, ещё выполняет в старом пуле
+            self.processing.encode_pool = self.encode_pool
+            if old_pool is not None:
+                old_pool.close()
+            return self.encode_pool.status() if self.encode_pool else None
+
+    def _start_capture_thread(self):
+        if self.capture_thread is None or not self.capture_thread.is_alive():
+            lost_packets = self.capture_thread.lost_packets if self.capture_thread else 0
+            self.capture_thread = CaptureThread(self, lost_packets)
+            self.capture_thread.start()
+
+    def _stop_capture_thread(self):
+        if self.capture_thread is not None:
+            self.capture_thread.stop_event.set()
+            self.capture_thread.join(timeout=5)
+
+    def _supervise(self):
+        """Ждёт обрыва связи без опроса и переподключает камеру"""
+        while True:
+            self._link_lost.wait()
+            if self._closing.is_set():
+                return
+            print(f"Camera {self.camera_id}: link lost, reconnecting")
+            self._reconnect()
+
+    def _reconnect(self):
+        with self.lock:
+            self._stop_capture_thread()
+            self._release()
+
+        delay = RECONNECT_BACKOFF_MIN
+        while not self._closing.is_set():
+            # Флаг снимаем до открытия: обрыв во время открытия не должен потеряться
+            self._link_lost.clear()
+            try:
+                _, self.name, self.device_info = find_camera_device(self.serial)
+                self.open(**self.config)
+                if self._closing.is_set():
+                    return
+                self.start_capture()
+                self.reconnects += 1
+                print(f"Camera {self.camera_id}: reconnected")
+                return
+            except Exception as e:
+                print(f"Camera {self.camera_id}: reconnect failed: {str(e)}")
+                with self.lock:
+                    self._release()
+            self._closing.wait(delay)
+            delay = min(delay * 2, RECONNECT_BACKOFF_MAX)
+
+    def _release(self):
+        cam, self.cam = self.cam, None
+        self.source = None
+        # Поток экспозиции пишет в дескриптор — останавливаем его раньше закрытия
+        self.exposure.stop()
+        if cam is None:
+            return
+        try:
+            cam.MV_CC_StopGrabbing()
+            cam.MV_CC_CloseDevice()
+            MvCamCtrldll.MV_CC_DestroyHandle(cam.handle)
         except Exception as e:
-            close_camera()
-            raise e
-
+            print(f"Error closing camera {self.camera_id}: {str(e)}")
+
+    def transport_stats(self):
+        with self.lock:
+            if self.cam is None:
+                raise RuntimeError("Camera is not open")
+            stats, self.net_stats_prev = read_transport_stats(self.cam, self.net_stats_prev)
+        stats["lost_packets"] = self.capture_thread.lost_packets if self.capture_thread else 0
+        return stats
+
+    def status(self):
+        thread = self.capture_thread
+        return {
+            "camera_id": self.camera_id,
+            "name": self.name,
+            "active": self.active,
+            "camera_initialized": self.cam is not None,
+            "viewers": self.viewers,
+            "acquisition": self.source.mode if self.source else None,
+            "dropped_frames": self.source.dropped if self.source else 0,
+            "throttled_frames": thread.throttled if thread else 0,
+            "processing_errors": thread.errors if thread else 0,
+            "fps": round(thread.fps, 1) if thread else 0.0,
+            "latency": self.latency_settings,
+            "capture_preset": self.preset_settings,
+            "exposure_mode": self.exposure_settings,
+            "exposure": self.exposure.status(),
+            "metering": self.meter.status(),
+            "denoise": self.denoiser.status(),
+            "stages": list(self.processing.stages),
+            "encoder": self.processing.encoder.name if self.processing.encoder else None,
+            "jpeg": self.encoder_settings["jpeg"].status(),
+            "encode_workers": self.encode_pool.workers if self.encode_pool else 0,
+            "reconnecting": self.reconnecting,
+            "reconnects": self.reconnects
+        }
+
+
+class RingCamera(ClientRegistry):
+    """Камера, которую снимает отдельный процесс capture_service.py.
+
+    Кадры и статус читаются из кольца в разделяемой памяти (FrameRingReader
+    вместо FrameBroadcaster), поэтому /video_feed, /snapshot и /camera_status
+    работают в любом числе процессов веб-сервера. Управление камерой
+    (экспозиция, пресеты, кодировщик) остаётся за процессом захвата.
+    """
 
-def close_camera():
-    global camera_instance, camera_active
+    def __init__(self, camera_id, reader):
+        self.camera_id = reader.status().get("camera_id") or camera_id or reader.name
+        self.broadcaster = reader
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    def status(self):
+        status = self.broadcaster.status()
+        status.update({
+            "capture_process": True,
+            "ring": self.broadcaster.name,
+            "ring_closed": self.broadcaster.closed,
+            # Зрители этого процесса веб-сервера; процесс захвата своих не видит
+            "viewers": self.viewers
+        })
+        if self.broadcaster.closed:
+            status["active"] = False
+        return status
+
+    def serves(self, camera_id):
+        """Кольцо принадлежит камере с таким серийным номером или именем (None — любой)"""
+        if camera_id is None or self.broadcaster.name == ring_name(camera_id):
+            return True
+        status = self.broadcaster.status()
+        return camera_id in (status.get("camera_id"), status.get("name"))
+
+
+def parse_stream_limits(args):
+    """?fps= и ?width= из параметров запроса; отсутствующие — None"""
+    fps = args.get('fps', type=float)
+    width = args.get('width', type=int)
+    if fps is not None and fps <= 0:
+        raise ValueError("fps must be positive")
+    if width is not None and width <= 0:
+        raise ValueError("width must be positive")
+    return fps, width
+
+
+def get_camera(camera_id=None):
+    """Камера из реестра по серийному номеру или имени; без id — первая запущенная"""
+    with CAMERAS_LOCK:
+        if camera_id is None:
+            return next(iter(CAMERAS.values()), None)
+        for pipeline in CAMERAS.values():
+            if camera_id in (pipeline.serial, pipeline.name):
+                return pipeline
+    return None
+
+
+def get_ring_camera(camera_id=None):
+    """Камера из кольца процесса захвата или None, если тот не запущен.
+
+    capture_service.py публикует в кольцо по умолчанию, если его не занял другой
+    процесс захвата, иначе в кольцо по серийному номеру. Поэтому камера по id
+    ищется в её кольце, затем в кольце по умолчанию (по статусу процесса захвата).
+    Закрытое кольцо (процесс захвата перезапущен или упал) подключается заново.
+    """
+    names = (ring_name(camera_id), ring_name()) if camera_id else (ring_name(),)
+    with CAMERAS_LOCK:
+        for name in names:
+            camera = RING_CAMERAS.get(name)
+            if camera is None or camera.broadcaster.closed:
+                RING_CAMERAS.pop(name, None)
+                try:
+                    reader = FrameRingReader(name)
+                except (FileNotFoundError, ValueError):
+                    continue
+                if reader.closed:
+                    reader.close()
+                    continue
+                camera = RING_CAMERAS[name] = RingCamera(camera_id, reader)
+            if camera.serves(camera_id):
+                return camera
+    return None
+
+
+def get_stream_camera(camera_id=None):
+    """Источник кадров для раздачи: камера этого процесса, иначе кольцо процесса захвата"""
+    pipeline = get_camera(camera_id)
+    if pipeline is not None:
+        return pipeline
+    return get_ring_camera(camera_id)
+
+
+def init_camera(camera_id=None, acquisition=ACQUISITION_POLLING, latency=LATENCY_DEFAULT, buffers=None,
+                preset=None, roi=None):
+    """Открывает камеру и регистрирует её в реестре; повторный вызов возвращает ту же камеру"""
+    pipeline = get_camera(camera_id) if camera_id is not None else None
+    if pipeline is None:
+        serial, name, device_info = find_camera_device(camera_id)
+        with CAMERAS_LOCK:
+            pipeline = CAMERAS.get(serial)
+            if pipeline is None:
+                pipeline = CameraPipeline(serial, name, device_info)
+                CAMERAS[serial] = pipeline
 
-    with camera_lock:
-        if camera_instance is not None:
-            try:
-                if camera_active:
-                    camera_instance.MV_CC_StopGrabbing()
-                if hasattr(camera_instance, 'handle'):
-                    camera_instance.MV_CC_CloseDevice()
-                    MvCamCtrldll.MV_CC_DestroyHandle(camera_instance.handle)
-            except Exception as e:
-                print(f"Error closing camera: {str(e)}")
-            finally:
-                camera_instance = None
-                camera_active = False
+    try:
+        pipeline.open(acquisition, latency, buffers, preset, roi)
+    except Exception:
+        with CAMERAS_LOCK:
+            CAMERAS.pop(pipeline.camera_id, None)
+        raise
+    return pipeline
+
+
+def close_camera(camera_id=None):
+    pipeline = get_camera(camera_id)
+    if pipeline is None:
+        return
+    with CAMERAS_LOCK:
+        CAMERAS.pop(pipeline.camera_id, None)
+    pipeline.close()
 
 # Настройка CORS (используйте flask-cors для более полной реализации)
 @app.after_request
@@ -184,25 +1432,23 @@ def smooth_route(points):
     except Exception as e:
         raise ValueError(f"Smoothing error: {str(e)}")
 
-# Эндпоинт для импорта SRT файлов
-@app.post("/api/import-srt")
-def import_srt():
+# Импорт SRT: тело ответа и код по имени и содержимому загруженного файла (None — файла нет)
+def import_srt_response(filename, content):
     global SRT_FILENAME
     try:
-        if 'file' not in request.files:
-            return jsonify({"status": "error", "message": "No file uploaded"}), 400
+        if filename is None:
+            return {"status": "error", "message": "No file uploaded"}, 400
 
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({"status": "error", "message": "No selected file"}), 400
+        if filename == '':
+            return {"status": "error", "message": "No selected file"}, 400
 
-        if not file.filename.lower().endswith('.srt'):
-            return jsonify({"status": "error", "message": "Only .srt files are allowed"}), 400
+        if not filename.lower().endswith('.srt'):
+            return {"status": "error", "message": "Only .srt files are allowed"}, 400
 
         # Сохраняем имя файла без расширения
-        SRT_FILENAME = file.filename.rsplit('.', 1)[0]  # Удаляем расширение .srt
+        SRT_FILENAME = filename.rsplit('.', 1)[0]  # Удаляем расширение .srt
 
-        srt_content = file.read().decode('utf-8')
+        srt_content = content.decode('utf-8')
         points = []
 
         for block in srt_content.split('\n\n'):
@@ -236,16 +1482,45 @@ def import_srt():
                 continue
 
         if not points:
-            return jsonify({"status": "error", "message": "No valid points found in SRT file"}), 400
+            return {"status": "error", "message": "No valid points found in SRT file"}, 400
 
-        return jsonify({
+        # name — для /video_feed_sync?name=, когда импорт и видео обслуживают разные процессы
+        return {
             "status": "success",
             "points": points,
-            "count": len(points)
-        })
+            "count": len(points),
+            "name": SRT_FILENAME
+        }, 200
 
     except Exception as e:
-        return jsonify({"status": "error", "message": f"SRT processing error: {str(e)}"}), 500
+        return {"status": "error", "message": f"SRT processing error: {str(e)}"}, 500
+
+# Эндпоинт для импорта SRT файлов
+@app.post("/api/import-srt")
+def import_srt():
+    file = request.files.get('file')
+    if file is None:
+        return import_srt_response(None, None)
+    return import_srt_response(file.filename, file.read())
+
+def build_gpx(points):
+    """GPX-трек из точек маршрута"""
+    gpx = gpxpy.gpx.GPX()
+    track = gpxpy.gpx.GPXTrack()
+    gpx.tracks.append(track)
+
+    segment = gpxpy.gpx.GPXTrackSegment()
+    track.segments.append(segment)
+
+    for point in points:
+        segment.points.append(
+            gpxpy.gpx.GPXTrackPoint(
+                latitude=point['lat'],
+                longitude=point['lng'],
+                elevation=point.get('alt', 100.0)
+            )
+        )
+    return gpx.to_xml()
 
 # Эндпоинт для экспорта в GPX формат
 @app.route('/api/export-gpx', methods=['POST'])
@@ -255,24 +1530,7 @@ def export_gpx():
         if not data or 'points' not in data:
             return handle_error("Invalid request data", 400)
 
-        points = data['points']
-        gpx = gpxpy.gpx.GPX()
-        track = gpxpy.gpx.GPXTrack()
-        gpx.tracks.append(track)
-
-        segment = gpxpy.gpx.GPXTrackSegment()
-        track.segments.append(segment)
-
-        for point in points:
-            segment.points.append(
-                gpxpy.gpx.GPXTrackPoint(
-                    latitude=point['lat'],
-                    longitude=point['lng'],
-                    elevation=point.get('alt', 100.0)
-                )
-            )
-
-        response = make_response(gpx.to_xml())
+        response = make_response(build_gpx(data['points']))
         response.headers['Content-Type'] = 'application/xml'
         response.headers['Content-Disposition'] = 'attachment; filename=route.gpx'
         return response
@@ -280,59 +1538,104 @@ def export_gpx():
     except Exception as e:
         return handle_error(str(e), 500)
 
-@app.route('/video_feed_sync')
-def video_feed_sync():
-    global SRT_FILENAME, route_points
+def sync_video_path(name=None):
+    """Видео к импортированному SRT; name — имя SRT без расширения (по умолчанию последний импорт).
+    Имя приходит от клиента (?name= или имя загруженного файла): путь за пределы static/ — ValueError"""
+    name = name or SRT_FILENAME
+    if not name:
+        return None
+    path = safe_join('static', f"{name}_avc.mp4")
+    if path is None or '/' in name or '\\' in name:
+        raise ValueError("Invalid video name")
+    return path
+
+class SyncVideoReader:
+    """Кадры видео, синхронного с SRT, в JPEG: ?fps= прореживает через grab()
+    (без декодирования и кодирования), ?width= уменьшает кадр"""
+
+    def __init__(self, path, max_fps=None, width=None):
+        self.path = path
+        self.width = width
+        self.cap = cv2.VideoCapture(path)
+        fps = self.cap.get(cv2.CAP_PROP_FPS) if self.cap.isOpened() else 0
+        frame_delay = 1 / fps if fps > 0 else 1/30  # default to 30fps if fps is 0
+        self.step = max(1, round(1 / (frame_delay * max_fps))) if max_fps else 1
+        # Пауза между отданными кадрами — точная синхронизация по FPS
+        self.delay = frame_delay * self.step
 
-    if not SRT_FILENAME:
-        return "No SRT file selected", 404
+    @property
+    def opened(self):
+        return self.cap.isOpened()
 
-    video_filename = f"{SRT_FILENAME}_avc.mp4"
-    video_path = f"static/{video_filename}"
+    def read(self):
+        """Следующий JPEG или None в конце видео"""
+        ret, frame = self.cap.read()
+        if not ret:
+            return None
 
-    def generate():
-        cap = cv2.VideoCapture(video_path)
-        if not cap.isOpened():
-            print(f"Failed to open video file: {video_path}")
-            return
+        if self.width is not None and self.width < frame.shape[1]:
+            height = max(round(frame.shape[0] * self.width / frame.shape[1]), 1)
+            frame = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
 
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_delay = 1 / fps if fps > 0 else 1/30  # default to 30fps if fps is 0
+        _, jpeg = cv2.imencode('.jpg', frame)
 
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
+        for _ in range(self.step - 1):
+            if not self.cap.grab():
                 break
+        return jpeg.tobytes()
 
-            _, jpeg = cv2.imencode('.jpg', frame)
-            frame_data = jpeg.tobytes()
+    def close(self):
+        self.cap.release()
 
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame_data + b'\r\n')
+@app.route('/video_feed_sync')
+def video_feed_sync():
+    try:
+        video_path = sync_video_path(request.args.get('name'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    if not video_path:
+        return "No SRT file selected", 404
 
-            time.sleep(frame_delay)  # Точная синхронизация по FPS
+    # ?fps=2&width=320 — прореживание и уменьшение кадров для этого клиента
+    try:
+        max_fps, width = parse_stream_limits(request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    def generate():
+        reader = SyncVideoReader(video_path, max_fps, width)
+        if not reader.opened:
+            print(f"Failed to open video file: {video_path}")
+            return
 
-        cap.release()
+        try:
+            while reader.opened:
+                jpeg = reader.read()
+                if jpeg is None:
+                    break
+                yield from mjpeg_part(jpeg)
+                time.sleep(reader.delay)
+        finally:
+            reader.close()
 
     return Response(generate(),
-                   mimetype='multipart/x-mixed-replace; boundary=frame',
+                   mimetype=MJPEG_MIMETYPE,
                    headers={'Cache-Control': 'no-cache'})
 
-@app.route('/api/calculate-route', methods=['POST'])
-def calculate_route():
+# Расчёт маршрута: тело ответа и код по разобранному JSON запроса
+def calculate_route_response(data):
     try:
-        data = request.get_json()
         if not data:
-            return jsonify({"status": "error", "message": "No data provided"}), 400
+            return {"status": "error", "message": "No data provided"}, 400
 
         # Валидация данных с помощью Pydantic
         try:
             route_request = RouteRequest(**data)
         except Exception as e:
-            return jsonify({"status": "error", "message": f"Invalid data format: {str(e)}"}), 400
+            return {"status": "error", "message": f"Invalid data format: {str(e)}"}, 400
 
         if len(route_request.points) < 2:
-            return jsonify({"status": "error", "message": "Need at least 2 points"}), 400
+            return {"status": "error", "message": "Need at least 2 points"}, 400
 
         # Проверка и сортировка точек
         start_points = [p for p in route_request.points if p.type == "start"]
@@ -340,14 +1643,14 @@ def calculate_route():
         mid_points = [p for p in route_request.points if p.type == "point"]
 
         if not start_points or not end_points:
-            return jsonify({"status": "error", "message": "Start and end points required"}), 400
+            return {"status": "error", "message": "Start and end points required"}, 400
 
         sorted_points = start_points + mid_points + end_points
 
         if route_request.smooth:
             points_dict = [p.dict() for p in sorted_points]
             smoothed = smooth_route(points_dict)
-            return jsonify({"status": "success", "points": smoothed})
+            return {"status": "success", "points": smoothed}, 200
         else:
             sharp_points = []
 
@@ -374,10 +1677,14 @@ def calculate_route():
                     })
 
             sharp_points.append(end_points[-1].dict())
-            return jsonify({"status": "success", "points": sharp_points})
+            return {"status": "success", "points": sharp_points}, 200
 
     except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+        return {"status": "error", "message": str(e)}, 500
+
+@app.route('/api/calculate-route', methods=['POST'])
+def calculate_route():
+    return calculate_route_response(request.get_json(silent=True))
 
 def calculate_geo_distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """
@@ -400,139 +1707,332 @@ def handle_exception(e):
         "message": e.description
     }), e.code
 
-@app.route('/video_feed')
-def video_feed():
-    def generate():
-        global STREAM_ACTIVE
-        with CAMERA_LOCK:
-            cam = CAMERA_INSTANCE
-            if not cam:
-                return
-
-            STREAM_ACTIVE = True
-            try:
-                while STREAM_ACTIVE:
-                    stFrame = MV_FRAME_OUT()
-                    memset(byref(stFrame), 0, sizeof(stFrame))
-
-                    ret = cam.MV_CC_GetImageBuffer(stFrame, 1000)
-                    if ret == MV_E_NO_DATA:
-                        continue
-                    elif ret != MV_OK:
-                        break
+@app.route('/video_feed', defaults={'camera_id': None})
+@app.route('/video_feed/<camera_id>')
+def video_feed(camera_id):
+    pipeline = get_stream_camera(camera_id)
+    if pipeline is None or pipeline.broadcaster.closed:
+        return Response(b'', mimetype=MJPEG_MIMETYPE)
 
-                    # Обработка кадра
-                    buffer = (c_ubyte * stFrame.stFrameInfo.nFrameLen).from_buffer_copy(
-                        string_at(stFrame.pBufAddr, stFrame.stFrameInfo.nFrameLen))
-                    img_np = np.frombuffer(buffer, dtype=np.uint8)
-                    img_np = img_np.reshape((stFrame.stFrameInfo.nHeight, stFrame.stFrameInfo.nWidth))
+    # ?max_latency=0.5 — своя граница задержки кадра для клиента, с
+    # ?fps=2&width=320 — не чаще fps кадров в секунду и не шире width пикселей
+    max_latency = request.args.get('max_latency', STREAM_LATENCY_BOUND, type=float)
+    try:
+        fps, width = parse_stream_limits(request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    remote_addr = request.remote_addr
 
-                    # Оптимизация и кодирование
-                    img_color = optimize_image(img_np)
-                    _, jpeg = cv2.imencode('.jpg', img_color)
-                    frame = jpeg.tobytes()
+    def generate():
+        # Регистрируем внутри генератора: finally сработает, только если он запущен
+        client = pipeline.add_client(remote_addr, max_latency, fps, width)
+        try:
+            for frame in pipeline.broadcaster.subscribe():
+                if not client.wants(frame):
+                    continue
+                jpeg = client.frame_bytes(frame)
+                start = time.monotonic()
+                yield from mjpeg_part(jpeg)
+                # Генератор продолжается, когда сервер дописал часть в сокет
+                client.sent(frame, len(jpeg), time.monotonic() - start)
+        finally:
+            pipeline.remove_client(client)
+
+    return Response(generate(), mimetype=MJPEG_MIMETYPE)
+
+def snapshot_etag(pipeline, frame, width=None):
+    """ETag снимка: камера, экземпляр раздачи, номер кадра и ширина варианта"""
+    etag = f"{pipeline.camera_id}-{pipeline.broadcaster.epoch}-{frame.seq}"
+    if width is not None:
+        etag += f"-w{width}"
+    return etag
+
+@app.route('/snapshot', defaults={'camera_id': None})
+@app.route('/snapshot/<camera_id>')
+def snapshot(camera_id):
+    """Последний закодированный кадр из памяти; камеру не трогает"""
+    pipeline = get_stream_camera(camera_id)
+    frame = pipeline.broadcaster.latest() if pipeline is not None else None
+    if frame is None:
+        return jsonify({"status": "error", "message": "No frame available"}), 503
+    # ?width=320 — уменьшенный вариант (кодируется один раз на кадр)
+    try:
+        _, width = parse_stream_limits(request.args)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    etag = snapshot_etag(pipeline, frame, width)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(frame.variant(width=width), mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.headers['X-Frame-Sequence'] = str(frame.seq)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+# Обработчики маршрутов камеры: возвращают тело ответа и код, чтобы их же вызывало
+# ASGI-приложение (backend_asgi.py); args — параметры запроса с get(key, default, type)
+CAMERA_NOT_INITIALIZED = {"status": "error", "message": "Camera is not initialized"}, 409
 
-                    cam.MV_CC_FreeImageBuffer(stFrame)
-            finally:
-                STREAM_ACTIVE = False
+def stream_stats_response(pipeline):
+    if pipeline is None:
+        return CAMERA_NOT_INITIALIZED
+    return {"status": "success", "camera_id": pipeline.camera_id, "clients": pipeline.client_stats()}, 200
 
-    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
+def list_cameras_response():
+    try:
+        found = [{"camera_id": serial, "name": name} for serial, name, _ in enumerate_cameras()]
+    except RuntimeError as e:
+        return {"status": "error", "message": str(e)}, 500
+    with CAMERAS_LOCK:
+        pipelines = list(CAMERAS.values())
+    return {
+        "status": "success",
+        "found": found,
+        "running": [pipeline.status() for pipeline in pipelines]
+    }, 200
+
+def camera_status_response(pipeline):
+    if pipeline is None:
+        return {"active": False, "camera_initialized": False}, 200
+    return pipeline.status(), 200
+
+def transport_stats_response(pipeline):
+    if pipeline is None:
+        return CAMERA_NOT_INITIALIZED
+    try:
+        stats = pipeline.transport_stats()
+    except RuntimeError as e:
+        return {"status": "error", "message": str(e)}, 500
+    return {"status": "success", "transport": pipeline.transport_settings, "stats": stats}, 200
+
+def start_camera_response(camera_id, args):
+    # ?mode=polling|callback — режим захвата, меняется только при новом старте
+    mode = args.get('mode', ACQUISITION_POLLING)
+    if mode not in (ACQUISITION_POLLING, ACQUISITION_CALLBACK):
+        return {"status": "error", "message": f"Unknown acquisition mode: {mode}"}, 400
+    # ?profile=latest-only|buffered-N — профиль задержки буферов SDK
+    try:
+        profile, buffers = parse_latency_profile(args.get('profile'))
+        roi = parse_roi(args)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    # ?preset=full|roi|binning2x2|decimation2x2 — пресет захвата
+    preset = args.get('preset')
+    if preset is not None and preset not in CAPTURE_PRESETS:
+        return {"status": "error", "message": f"Unknown capture preset: {preset}"}, 400
 
-@app.route('/camera_status')
-def camera_status():
-    return jsonify({
-        "active": STREAM_ACTIVE,
-        "camera_initialized": CAMERA_INSTANCE is not None
-    })
-
-@app.route('/start_camera')
-def start_camera():
-    global CAMERA_INSTANCE
-    with CAMERA_LOCK:
-        if CAMERA_INSTANCE is None:
-            try:
-                CAMERA_INSTANCE = init_camera()
-                return jsonify({"status": "success"})
-            except Exception as e:
-                CAMERA_INSTANCE = None
-                return jsonify({"status": "error", "message": str(e)}), 500
-        return jsonify({"status": "success"})
-
-@app.route('/stop_camera')
-def stop_camera():
-    global CAMERA_INSTANCE, STREAM_ACTIVE
-    with CAMERA_LOCK:
-        STREAM_ACTIVE = False
-        if CAMERA_INSTANCE:
-            close_camera()
-            CAMERA_INSTANCE = None
+    try:
+        pipeline = init_camera(camera_id, mode, profile, buffers, preset, roi)
+        pipeline.start_capture()
+    except Exception as e:
+        return {"status": "error", "message": str(e)}, 500
+    return {"status": "success", "camera_id": pipeline.camera_id, "latency": pipeline.latency_settings}, 200
+
+def capture_preset_response(pipeline, args):
+    if pipeline is None:
+        return CAMERA_NOT_INITIALIZED
+    name = args.get('name')
+    if name is None:
+        return {"status": "success", "presets": list(CAPTURE_PRESETS), "capture_preset": pipeline.preset_settings}, 200
+    try:
+        settings = pipeline.set_preset(name, parse_roi(args))
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    except RuntimeError as e:
+        return {"status": "error", "message": str(e)}, 500
+    return {"status": "success", "capture_preset": settings}, 200
+
+def exposure_mode_response(pipeline, args):
+    if pipeline is None:
+        return CAMERA_NOT_INITIALIZED
+    # ?mode=auto|software&fps=25&readout_us=3000 — без fps выдержка не ограничивается
+    mode = args.get('mode')
+    if mode is None:
+        return {"status": "success", "exposure_mode": pipeline.exposure_settings,
+                "exposure": pipeline.exposure.status()}, 200
+    try:
+        target_fps = args.get('fps', type=float)
+        readout_us = args.get('readout_us', type=float)
+        settings = pipeline.set_exposure_mode(mode, target_fps, readout_us)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    return {"status": "success", "exposure_mode": settings, "exposure": pipeline.exposure.status()}, 200
+
+def metering_response(pipeline, args):
+    if pipeline is None:
+        return CAMERA_NOT_INITIALIZED
+    # ?mode=average|center|roi&stride=4|8&roi=x,y,w,h (доли кадра)&clip_limit=0.02
+    mode = args.get('mode')
+    if mode is None:
+        return {"status": "success", "metering": pipeline.meter.status()}, 200
+    try:
+        stride = args.get('stride', METER_STRIDE, type=int)
+        roi = args.get('roi')
+        if roi is not None:
+            roi = tuple(float(value) for value in roi.split(','))
+            if len(roi) != 4:
+                raise ValueError("Metering ROI must be x,y,w,h")
+        clip_limit = args.get('clip_limit', pipeline.meter.settings[3], type=float)
+        pipeline.meter.configure(mode, stride, roi, clip_limit)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    return {"status": "success", "metering": pipeline.meter.status()}, 200
+
+def denoise_response(pipeline, args):
+    if pipeline is None:
+        return CAMERA_NOT_INITIALIZED
+    # ?enabled=1|0&alpha=0.3&motion_threshold=12
+    enabled = args.get('enabled')
+    if enabled is None:
+        return {"status": "success", "denoise": pipeline.denoiser.status()}, 200
+    try:
+        pipeline.denoiser.configure(enabled in ('1', 'true', 'on'),
+                                    args.get('alpha', type=float),
+                                    args.get('motion_threshold', type=float))
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    return {"status": "success", "denoise": pipeline.denoiser.status()}, 200
+
+def processing_response(pipeline, args):
+    if pipeline is None:
+        return CAMERA_NOT_INITIALIZED
+    # ?stages=denoise,meter,tone-map,encode — порядок и состав этапов; ?rotate=0|90|180|270 — поворот кадра;
+    # без параметров — только время этапов
+    stages = args.get('stages')
+    rotate = args.get('rotate', type=int)
+    try:
+        if stages is not None:
+            pipeline.processing.configure(parse_stages(stages))
+        if rotate is not None:
+            pipeline.processing.set_rotation(rotate)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    return {"status": "success", "processing": pipeline.processing.status()}, 200
+
+def encode_workers_response(pipeline, args):
+    if pipeline is None:
+        return CAMERA_NOT_INITIALIZED
+    # ?workers=N — процессов JPEG-кодирования (0 — в потоке захвата)
+    workers = args.get('workers', type=int)
+    if workers is None:
+        pool = pipeline.encode_pool
+        return {"status": "success", "encode_pool": pool.status() if pool else None}, 200
+    try:
+        settings = pipeline.set_encode_workers(workers)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    return {"status": "success", "encode_pool": settings}, 200
+
+def encoder_response(pipeline, args):
+    if pipeline is None:
+        return CAMERA_NOT_INITIALIZED
+    # ?name=auto|opencv|pil|simplejpeg&quality=80&subsampling=420&progressive=0&optimize=0
+    if not args:
+        return {"status": "success", "available": available_encoders(),
+                "encoder": pipeline.processing.encoder.name if pipeline.processing.encoder else None,
+                "jpeg": pipeline.encoder_settings["jpeg"].status()}, 200
+    current = pipeline.encoder_settings["jpeg"]
+    name = args.get('name', 'auto')
+    try:
+        jpeg = JpegSettings(args.get('quality', current.quality, type=int),
+                            args.get('subsampling', current.subsampling),
+                            args.get('progressive', str(int(current.progressive))) in ('1', 'true', 'on'),
+                            args.get('optimize', str(int(current.optimize))) in ('1', 'true', 'on'))
+        selected = pipeline.set_encoder(None if name == 'auto' else name, jpeg)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+    return {"status": "success", "encoder": selected, "jpeg": jpeg.status()}, 200
+
+@app.route('/stream_stats', defaults={'camera_id': None})
+@app.route('/stream_stats/<camera_id>')
+def stream_stats(camera_id):
+    return stream_stats_response(get_stream_camera(camera_id))
+
+@app.route('/cameras')
+def list_cameras():
+    return list_cameras_response()
+
+@app.route('/camera_status', defaults={'camera_id': None})
+@app.route('/camera_status/<camera_id>')
+def camera_status(camera_id):
+    return camera_status_response(get_stream_camera(camera_id))
+
+@app.route('/transport_stats', defaults={'camera_id': None})
+@app.route('/transport_stats/<camera_id>')
+def transport_stats(camera_id):
+    return transport_stats_response(get_camera(camera_id))
+
+@app.route('/start_camera', defaults={'camera_id': None})
+@app.route('/start_camera/<camera_id>')
+def start_camera(camera_id):
+    return start_camera_response(camera_id, request.args)
+
+@app.route('/capture_preset', defaults={'camera_id': None})
+@app.route('/capture_preset/<camera_id>')
+def capture_preset(camera_id):
+    return capture_preset_response(get_camera(camera_id), request.args)
+
+@app.route('/exposure_mode', defaults={'camera_id': None})
+@app.route('/exposure_mode/<camera_id>')
+def exposure_mode(camera_id):
+    return exposure_mode_response(get_camera(camera_id), request.args)
+
+@app.route('/metering', defaults={'camera_id': None})
+@app.route('/metering/<camera_id>')
+def metering(camera_id):
+    return metering_response(get_camera(camera_id), request.args)
+
+@app.route('/denoise', defaults={'camera_id': None})
+@app.route('/denoise/<camera_id>')
+def denoise(camera_id):
+    return denoise_response(get_camera(camera_id), request.args)
+
+@app.route('/processing', defaults={'camera_id': None})
+@app.route('/processing/<camera_id>')
+def processing(camera_id):
+    return processing_response(get_camera(camera_id), request.args)
+
+@app.route('/encode_workers', defaults={'camera_id': None})
+@app.route('/encode_workers/<camera_id>')
+def encode_workers(camera_id):
+    return encode_workers_response(get_camera(camera_id), request.args)
+
+@app.route('/encoder', defaults={'camera_id': None})
+@app.route('/encoder/<camera_id>')
+def encoder(camera_id):
+    return encoder_response(get_camera(camera_id), request.args)
+
+@app.route('/stop_camera', defaults={'camera_id': None})
+@app.route('/stop_camera/<camera_id>')
+def stop_camera(camera_id):
+    close_camera(camera_id)
     return jsonify({"status": "success"})
 
-def generate_frames():
-    cam = init_camera()
-    cam.MV_CC_SetEnumValue("ExposureAuto", MV_EXPOSURE_AUTO_MODE_OFF)  # Отключаем автоэкспозицию!
-    cam.MV_CC_SetFloatValue("ExposureTime", INITIAL_EXPOSURE)
+def generate_frames(camera_id=None):
+    pipeline = init_camera(camera_id)
+    cam = pipeline.cam
+    pipeline.set_exposure_mode(EXPOSURE_SOFTWARE, pipeline.exposure_settings["target_fps"],
+                               pipeline.exposure_settings["readout_us"])
 
     try:
         while not STOP_EVENT.is_set():
-            stFrame = MV_FRAME_OUT()
-            memset(byref(stFrame), 0, sizeof(stFrame))
-
-            ret = cam.MV_CC_GetImageBuffer(stFrame, 1000)
+            ret, grabbed = grab_frame(cam, 1000)
             if ret != MV_OK:
                 continue
 
-            # Декодируем кадр
-            buffer = (c_ubyte * stFrame.stFrameInfo.nFrameLen).from_buffer_copy(
-                string_at(stFrame.pBufAddr, stFrame.stFrameInfo.nFrameLen))
-            img_np = np.frombuffer(buffer, dtype=np.uint8)
-            img_np = img_np.reshape((stFrame.stFrameInfo.nHeight, stFrame.stFrameInfo.nWidth))
-
-            # Оптимизируем яркость
-            img_processed = optimize_image(img_np)
-
-            # Обновляем экспозицию камеры
-            cam.MV_CC_SetFloatValue("ExposureTime", current_exposure)
-
-            # Кодируем в JPEG и отправляем
-            _, jpeg = cv2.imencode('.jpg', img_processed)
-            yield (b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+            with grabbed:
+                # Шумоподавление, замер, коррекция яркости и JPEG — этапы pipeline.processing
+                jpeg = pipeline.processing.run(grabbed.image)
+            if jpeg is None:
+                continue
 
-            cam.MV_CC_FreeImageBuffer(stFrame)
+            yield from mjpeg_part(jpeg)
     finally:
+        pipeline.exposure.stop()
         cam.MV_CC_StopGrabbing()
 
-def optimize_image(img):
-    global current_exposure
-    current_brightness = np.mean(img)
-    error = TARGET_BRIGHTNESS - current_brightness
-
-    # Асимметричная регулировка:
-    # - Медленно уменьшаем экспозицию при светлых кадрах (SMOOTHING_FACTOR_DOWN)
-    # - Быстрее увеличиваем при тёмных (SMOOTHING_FACTOR_UP)
-    smoothing_factor = SMOOTHING_FACTOR_DOWN if error < 0 else SMOOTHING_FACTOR_UP
-    exposure_adjustment = error * smoothing_factor * 100
-
-    # Запрещаем экспозиции опускаться ниже MIN_EXPOSURE
-    new_exposure = max(MIN_EXPOSURE, current_exposure + exposure_adjustment)
-    new_exposure = min(new_exposure, MAX_EXPOSURE)
-
-    # Применяем новую экспозицию
-    current_exposure = new_exposure
-
-    # Лёгкая программная коррекция (без пересветов)
-    gain = 1.0 + (error / 255.0) * 0.2  # Очень мягкое усиление
-    img_corrected = cv2.convertScaleAbs(img, alpha=gain, beta=0)
-
-    # Для тёмных кадров — гистограммное выравнивание
-    if current_brightness < 30:
-        img_corrected = cv2.equalizeHist(img_corrected)
-
-    return cv2.cvtColor(img_corrected, cv2.COLOR_GRAY2BGR)
-
 # Запуск сервера
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
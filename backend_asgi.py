@@ -0,0 +1,406 @@
+# ASGI-приложение (FastAPI) с теми же маршрутами, что и backend.py: расчёт маршрута, импорт SRT,
+# экспорт GPX, управление камерами и видеопотоки. Потоки — асинхронные генераторы: зритель ждёт
+# кадр в корутине, а не занимает поток ОС, так что сотни медленных клиентов стоят сотни корутин.
+# Запуск: python backend_asgi.py [процессов]  или  uvicorn backend_asgi:app --host 0.0.0.0 --port 8000 --workers N
+# Больше одного процесса — только вместе с capture_service.py: камеру снимает он, а процессы
+# веб-сервера читают кадры из кольца в разделяемой памяти.
+import asyncio
+import os
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.security import safe_join
+
+from backend import (CAMERAS, CAMERAS_LOCK, STREAM_LATENCY_BOUND, SyncVideoReader, build_gpx,
+                     calculate_route_response, camera_status_response, capture_preset_response, close_camera,
+                     denoise_response, encode_workers_response, encoder_response, exposure_mode_response,
+                     get_camera, get_stream_camera, import_srt_response, list_cameras_response, metering_response,
+                     parse_stream_limits, processing_response, snapshot_etag, start_camera_response,
+                     stream_stats_response, sync_video_path, transport_stats_response)
+from encoding import MJPEG_MIMETYPE, mjpeg_part
+from frame_ring import FrameRingReader, PollBackoff
+
+ASGI_HOST = "0.0.0.0"
+ASGI_PORT = 8000
+ASGI_WORKERS = 1                   # Процессов uvicorn; больше одного — только с capture_service.py
+
+# Статика отдаётся из каталога модуля, как send_from_directory('.') во Flask
+STATIC_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Источник кадров (FrameBroadcaster или FrameRingReader) -> FrameFeed этого процесса
+FEEDS = {}
+
+
+class FrameFeed:
+    """Кадры одного источника для корутин event loop.
+
+    Один FrameFeed на источник в процессе: кадр от потока захвата приходит
+    через call_soon_threadsafe, а кольцо процесса захвата опрашивает одна
+    задача на всех зрителей. Зрители ждут asyncio.Event, который заменяется
+    новым на каждый кадр; медленный зритель перескакивает на последний кадр.
+    """
+
+    def __init__(self, source, loop):
+        self.source = source
+        self.loop = loop
+        self.frame = source.latest()
+        self.closed = source.closed
+        self.subscribers = 0
+        self._event = asyncio.Event()
+        self._poller = None
+        if isinstance(source, FrameRingReader):
+            self._poller = loop.create_task(self._poll())
+        else:
+            source.add_listener(self._on_frame)
+
+    def _on_frame(self, frame):
+        # Поток захвата: в event loop только передаём кадр
+        try:
+            self.loop.call_soon_threadsafe(self._set, frame)
+        except RuntimeError:
+            pass  # event loop уже закрыт — сервер останавливается
+
+    def _set(self, frame):
+        if frame is None:
+            self.closed = True
+        else:
+            self.frame = frame
+        self._event.set()
+        self._event = asyncio.Event()
+
+    async def _poll(self):
+        reader = self.source
+        seq = self.frame.seq if self.frame is not None else 0
+        backoff = PollBackoff()
+        while not reader.closed:
+            latest = reader.latest_seq
+            changed = latest != seq
+            if changed:
+                frame = reader.read(latest)
+                if frame is not None:
+                    seq = latest
+                    self._set(frame)
+            await asyncio.sleep(backoff.next(changed))
+        self._set(None)
+
+    async def frames(self):
+        """Новые кадры для одного зрителя; завершается при остановке источника.
+        Итерацию начинать сразу после frame_feed(), без await между ними — иначе лента
+        может успеть отключиться от источника без зрителей"""
+        cursor = None
+        self.subscribers += 1
+        try:
+            while not self.closed:
+                frame = self.frame
+                if frame is not None and frame.seq != cursor:
+                    cursor = frame.seq
+                    yield frame
+                    continue
+                await self._event.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers:
+                self.detach()
+
+    def detach(self):
+        """Отключиться от источника, когда не осталось зрителей"""
+        if FEEDS.get(self.source) is self:
+            del FEEDS[self.source]
+        if self._poller is not None:
+            self._poller.cancel()
+        else:
+            self.source.remove_listener(self._on_frame)
+
+
+def frame_feed(source):
+    feed = FEEDS.get(source)
+    if feed is None or feed.closed:
+        feed = FEEDS[source] = FrameFeed(source, asyncio.get_running_loop())
+    return feed
+
+
+def query_args(request):
+    """Параметры запроса с get(key, default, type), как request.args во Flask"""
+    return MultiDict(request.query_params.multi_items())
+
+
+def json_response(result):
+    payload, status_code = result
+    return JSONResponse(payload, status_code=status_code)
+
+
+def error_response(message, status_code):
+    return JSONResponse({"status": "error", "message": message}, status_code=status_code)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # Камеры этого процесса закрываем при остановке сервера, иначе SDK держит устройство
+    with CAMERAS_LOCK:
+        camera_ids = list(CAMERAS)
+    for camera_id in camera_ids:
+        await run_in_threadpool(close_camera, camera_id)
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Настройка CORS
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+@app.exception_handler(StarletteHTTPException)
+async def handle_exception(request, exc):
+    return error_response(exc.detail, exc.status_code)
+
+
+@app.get("/")
+async def serve_index():
+    return FileResponse(os.path.join(STATIC_ROOT, 'index.html'))
+
+
+@app.post("/api/calculate-route")
+async def calculate_route(request: Request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    return json_response(calculate_route_response(data))
+
+
+@app.post("/api/import-srt")
+async def import_srt(file: Optional[UploadFile] = File(None)):
+    if file is None:
+        return json_response(import_srt_response(None, None))
+    return json_response(import_srt_response(file.filename, await file.read()))
+
+
+@app.post("/api/export-gpx")
+async def export_gpx(request: Request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data or 'points' not in data:
+        return error_response("Invalid request data", 400)
+    try:
+        xml = build_gpx(data['points'])
+    except Exception as e:
+        return error_response(str(e), 500)
+    return Response(xml, media_type='application/xml',
+                    headers={'Content-Disposition': 'attachment; filename=route.gpx'})
+
+
+@app.get("/video_feed_sync")
+async def video_feed_sync(request: Request):
+    args = query_args(request)
+    try:
+        video_path = sync_video_path(args.get('name'))
+    except ValueError as e:
+        return error_response(str(e), 400)
+    if not video_path:
+        return PlainTextResponse("No SRT file selected", status_code=404)
+
+    # ?fps=2&width=320 — прореживание и уменьшение кадров для этого клиента
+    try:
+        max_fps, width = parse_stream_limits(args)
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    async def generate():
+        reader = await run_in_threadpool(SyncVideoReader, video_path, max_fps, width)
+        if not reader.opened:
+            print(f"Failed to open video file: {video_path}")
+            return
+
+        try:
+            while reader.opened:
+                # Декодирование и JPEG — в пуле потоков, паузу между кадрами корутина просто спит
+                jpeg = await run_in_threadpool(reader.read)
+                if jpeg is None:
+                    break
+                for chunk in mjpeg_part(jpeg):
+                    yield chunk
+                await asyncio.sleep(reader.delay)
+        finally:
+            reader.close()
+
+    return StreamingResponse(generate(), media_type=MJPEG_MIMETYPE, headers={'Cache-Control': 'no-cache'})
+
+
+@app.get("/video_feed")
+@app.get("/video_feed/{camera_id}")
+async def video_feed(request: Request, camera_id: Optional[str] = None):
+    # Поиск камеры может подключать кольцо и читать его статус (блокировка реестра, ожидание) — не в event loop
+    pipeline = await run_in_threadpool(get_stream_camera, camera_id)
+    if pipeline is None or pipeline.broadcaster.closed:
+        return Response(b'', media_type=MJPEG_MIMETYPE)
+
+    # ?max_latency=0.5 — своя граница задержки кадра для клиента, с
+    # ?fps=2&width=320 — не чаще fps кадров в секунду и не шире width пикселей
+    args = query_args(request)
+    max_latency = args.get('max_latency', STREAM_LATENCY_BOUND, type=float)
+    try:
+        fps, width = parse_stream_limits(args)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    remote_addr = request.client.host if request.client else None
+
+    async def generate():
+        client = pipeline.add_client(remote_addr, max_latency, fps, width)
+        try:
+            # Ленту берём здесь, а не в обработчике: между ними последний зритель мог уйти и
+            # отключить её от источника (detach). Между frame_feed() и подпиской в frames() нет await
+            async for frame in frame_feed(pipeline.broadcaster).frames():
+                if not client.wants(frame):
+                    continue
+                # Готовый вариант берём сразу; новый (другое качество или размер) кодируется
+                # в пуле потоков, а не в event loop
+                jpeg = client.frame_bytes(frame, encode=False)
+                if jpeg is None:
+                    jpeg = await run_in_threadpool(client.frame_bytes, frame)
+                start = time.monotonic()
+                for chunk in mjpeg_part(jpeg):
+                    yield chunk
+                # Генератор продолжается, когда сервер передал часть в сокет (с учётом flow control)
+                client.sent(frame, len(jpeg), time.monotonic() - start)
+        finally:
+            pipeline.remove_client(client)
+
+    return StreamingResponse(generate(), media_type=MJPEG_MIMETYPE)
+
+
+@app.get("/snapshot")
+@app.get("/snapshot/{camera_id}")
+async def snapshot(request: Request, camera_id: Optional[str] = None):
+    """Последний закодированный кадр из памяти; камеру не трогает"""
+    pipeline = await run_in_threadpool(get_stream_camera, camera_id)
+    frame = pipeline.broadcaster.latest() if pipeline is not None else None
+    if frame is None:
+        return error_response("No frame available", 503)
+    # ?width=320 — уменьшенный вариант (кодируется один раз на кадр)
+    try:
+        _, width = parse_stream_limits(query_args(request))
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    etag = snapshot_etag(pipeline, frame, width)
+    headers = {'ETag': quote_etag(etag), 'X-Frame-Sequence': str(frame.seq), 'Cache-Control': 'no-cache'}
+    if etag in parse_etags(request.headers.get('if-none-match')):
+        return Response(status_code=304, headers=headers)
+    jpeg = frame.variant(width=width, encode=False)
+    if jpeg is None:
+        jpeg = await run_in_threadpool(frame.variant, None, width)
+    return Response(jpeg, media_type='image/jpeg', headers=headers)
+
+
+@app.get("/stream_stats")
+@app.get("/stream_stats/{camera_id}")
+def stream_stats(camera_id: Optional[str] = None):
+    return json_response(stream_stats_response(get_stream_camera(camera_id)))
+
+
+@app.get("/camera_status")
+@app.get("/camera_status/{camera_id}")
+def camera_status(camera_id: Optional[str] = None):
+    return json_response(camera_status_response(get_stream_camera(camera_id)))
+
+
+# Управление камерой — обычные def: FastAPI выполняет их в пуле потоков, event loop не ждёт SDK.
+# Так же /stream_stats и /camera_status: поиск камеры берёт блокировку реестра и читает статус кольца
+
+@app.get("/cameras")
+def list_cameras():
+    return json_response(list_cameras_response())
+
+
+@app.get("/transport_stats")
+@app.get("/transport_stats/{camera_id}")
+def transport_stats(camera_id: Optional[str] = None):
+    return json_response(transport_stats_response(get_camera(camera_id)))
+
+
+@app.get("/start_camera")
+@app.get("/start_camera/{camera_id}")
+def start_camera(request: Request, camera_id: Optional[str] = None):
+    return json_response(start_camera_response(camera_id, query_args(request)))
+
+
+@app.get("/capture_preset")
+@app.get("/capture_preset/{camera_id}")
+def capture_preset(request: Request, camera_id: Optional[str] = None):
+    return json_response(capture_preset_response(get_camera(camera_id), query_args(request)))
+
+
+@app.get("/exposure_mode")
+@app.get("/exposure_mode/{camera_id}")
+def exposure_mode(request: Request, camera_id: Optional[str] = None):
+    return json_response(exposure_mode_response(get_camera(camera_id), query_args(request)))
+
+
+@app.get("/metering")
+@app.get("/metering/{camera_id}")
+def metering(request: Request, camera_id: Optional[str] = None):
+    return json_response(metering_response(get_camera(camera_id), query_args(request)))
+
+
+@app.get("/denoise")
+@app.get("/denoise/{camera_id}")
+def denoise(request: Request, camera_id: Optional[str] = None):
+    return json_response(denoise_response(get_camera(camera_id), query_args(request)))
+
+
+@app.get("/processing")
+@app.get("/processing/{camera_id}")
+def processing(request: Request, camera_id: Optional[str] = None):
+    return json_response(processing_response(get_camera(camera_id), query_args(request)))
+
+
+@app.get("/encode_workers")
+@app.get("/encode_workers/{camera_id}")
+def encode_workers(request: Request, camera_id: Optional[str] = None):
+    return json_response(encode_workers_response(get_camera(camera_id), query_args(request)))
+
+
+@app.get("/encoder")
+@app.get("/encoder/{camera_id}")
+def encoder(request: Request, camera_id: Optional[str] = None):
+    return json_response(encoder_response(get_camera(camera_id), query_args(request)))
+
+
+@app.get("/stop_camera")
+@app.get("/stop_camera/{camera_id}")
+def stop_camera(camera_id: Optional[str] = None):
+    close_camera(camera_id)
+    return {"status": "success"}
+
+
+# Статические файлы — последним маршрутом, чтобы не перекрывать остальные
+@app.get("/{path:path}")
+async def serve_static(path: str):
+    filename = safe_join(STATIC_ROOT, path)
+    if filename is None or not os.path.isfile(filename):
+        raise StarletteHTTPException(status_code=404, detail="Not Found")
+    return FileResponse(filename)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else ASGI_WORKERS
+    # Несколько процессов uvicorn запускает только по строке импорта приложения
+    uvicorn.run("backend_asgi:app", host=ASGI_HOST, port=ASGI_PORT, workers=workers)
@@ -0,0 +1,106 @@
+# Микробенчмарк optimize_image: прежняя версия (mean + convertScaleAbs + equalizeHist + GRAY2BGR)
+# против LUT-версии из image_processing, с JPEG-кодированием и без, стоимость замера яркости
+# и расхождение результата LUT-версии с прежним (замер по выборке — приближение).
+# Запуск: python bench_optimize_image.py [кадров]
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from image_processing import (ExposureController, Meter, optimize_image, TARGET_BRIGHTNESS, SMOOTHING_FACTOR_UP,
+                              SMOOTHING_FACTOR_DOWN, MIN_EXPOSURE, MAX_EXPOSURE, METER_AVERAGE, METER_CENTER,
+                              METER_ROI)
+
+RESOLUTIONS = {
+    "1080p": (1080, 1920),
+    "5MP": (2048, 2448),
+}
+
+
+def legacy_optimize_image(img, exposure):
+    """Исходная реализация из backend.py — для сравнения"""
+    current_brightness = np.mean(img)
+    error = TARGET_BRIGHTNESS - current_brightness
+    smoothing_factor = SMOOTHING_FACTOR_DOWN if error < 0 else SMOOTHING_FACTOR_UP
+    exposure_adjustment = error * smoothing_factor * 100
+    new_exposure = max(MIN_EXPOSURE, exposure.current + exposure_adjustment)
+    exposure.current = min(new_exposure, MAX_EXPOSURE)
+    gain = 1.0 + (error / 255.0) * 0.2
+    img_corrected = cv2.convertScaleAbs(img, alpha=gain, beta=0)
+    if current_brightness < 30:
+        img_corrected = cv2.equalizeHist(img_corrected)
+    return cv2.cvtColor(img_corrected, cv2.COLOR_GRAY2BGR)
+
+
+def make_frame(shape, brightness):
+    """Синтетический кадр: градиент с шумом вокруг заданной яркости"""
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(-brightness / 2, brightness / 2, shape[1], dtype=np.float32)
+    frame = brightness + gradient[None, :] + rng.normal(0, 8, shape).astype(np.float32)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def bench(func, frame, frames, encode):
+    exposure = ExposureController()
+    func(frame, exposure)  # прогрев
+    start = time.perf_counter()
+    for _ in range(frames):
+        out = func(frame, exposure)
+        if encode:
+            cv2.imencode('.jpg', out)
+    return (time.perf_counter() - start) / frames * 1000.0
+
+
+def compare(frame):
+    """Сколько пикселей LUT-версии отличается от прежней версии и максимальное отличие"""
+    legacy = legacy_optimize_image(frame, ExposureController())[..., 0]
+    diff = cv2.absdiff(legacy, optimize_image(frame, ExposureController(), mono=True))
+    return np.count_nonzero(diff), int(diff.max())
+
+
+def bench_metering(func, frame, frames):
+    func(frame)  # прогрев
+    start = time.perf_counter()
+    for _ in range(frames):
+        func(frame)
+    return (time.perf_counter() - start) / frames * 1000.0
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    variants = [
+        ("legacy (BGR)", legacy_optimize_image),
+        ("lut (BGR)", lambda img, exp: optimize_image(img, exp)),
+        ("lut (mono)", lambda img, exp: optimize_image(img, exp, mono=True)),
+    ]
+    print(f"{'resolution':<10} {'scene':<7} {'variant':<14} {'process ms':>11} {'+jpeg ms':>10}")
+    for res_name, shape in RESOLUTIONS.items():
+        for scene, brightness in (("bright", 120), ("dark", 20)):
+            frame = make_frame(shape, brightness)
+            for name, func in variants:
+                process_ms = bench(func, frame, frames, encode=False)
+                total_ms = bench(func, frame, frames, encode=True)
+                print(f"{res_name:<10} {scene:<7} {name:<14} {process_ms:>11.2f} {total_ms:>10.2f}")
+
+    print()
+    print(f"{'resolution':<10} {'scene':<7} {'differing px':>13} {'max diff':>9}")
+    for res_name, shape in RESOLUTIONS.items():
+        for scene, brightness in (("bright", 120), ("dark", 20)):
+            differing, max_diff = compare(make_frame(shape, brightness))
+            print(f"{res_name:<10} {scene:<7} {differing:>13} {max_diff:>9}")
+
+    meters = [("np.mean", np.mean)]
+    for mode, roi in ((METER_AVERAGE, None), (METER_CENTER, None), (METER_ROI, (0.25, 0.5, 0.5, 0.5))):
+        for stride in (4, 8):
+            meters.append((f"{mode}/{stride}", Meter(mode, stride, roi).measure))
+    print()
+    print(f"{'resolution':<10} {'meter':<14} {'ms':>8}")
+    for res_name, shape in RESOLUTIONS.items():
+        frame = make_frame(shape, 120)
+        for name, func in meters:
+            print(f"{res_name:<10} {name:<14} {bench_metering(func, frame, frames):>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# Отдельный процесс захвата: единственный владелец камеры, публикует кадры в кольцо
+# разделяемой памяти (frame_ring), из которого читают любые процессы веб-сервера.
+# Запуск: python capture_service.py [camera_id] [polling|callback]
+import sys
+import threading
+
+from backend import ACQUISITION_CALLBACK, ACQUISITION_POLLING, init_camera, close_camera
+from frame_ring import RING_STATUS_INTERVAL, FrameRingWriter, ring_alive, ring_name
+
+
+class RingPublisher(threading.Thread):
+    """Переносит кадры из FrameBroadcaster камеры в кольцо и раз в
+    RING_STATUS_INTERVAL обновляет там статус камеры для /camera_status.
+
+    Кольцо выделяется один раз под полный кадр матрицы: смена пресета или ROI
+    не пересоздаёт его и не обрывает потоки зрителей.
+    """
+
+    def __init__(self, pipeline, ring):
+        threading.Thread.__init__(self, daemon=True, name=f"ring-{pipeline.camera_id}")
+        self.pipeline = pipeline
+        self.ring = ring
+        self.writer = None
+        shape = pipeline.max_frame_shape()
+        if shape is not None:
+            self.writer = FrameRingWriter.for_shape(ring, shape)
+            # Статус сразу: по нему читатели находят камеру в кольце по умолчанию
+            self.writer.write_status(self._status())
+            print(f"Frame ring {ring}: up to {shape[1]}x{shape[0]}")
+        # Поток статуса не должен писать в кольцо, которое как раз пересоздаётся
+        self.writer_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.status_thread = threading.Thread(target=self._write_status, daemon=True,
+                                              name=f"ring-status-{pipeline.camera_id}")
+
+    def run(self):
+        self.status_thread.start()
+        for frame in self.pipeline.broadcaster.subscribe():
+            if self.stop_event.is_set():
+                break
+            writer = self.writer
+            # Камера не сообщила размер матрицы — кольцо под первый кадр; пересоздаётся (с обрывом
+            # потоков зрителей), только если кадр в него не поместился
+            if writer is None or not writer.fits(frame.jpeg, frame.image):
+                with self.writer_lock:
+                    if writer is not None:
+                        writer.close()
+                    writer = self.writer = FrameRingWriter.for_shape(self.ring, frame.image.shape)
+                print(f"Frame ring {self.ring}: {frame.image.shape[1]}x{frame.image.shape[0]}")
+            writer.publish(frame.jpeg, frame.image, frame.captured)
+
+    def _status(self):
+        status = self.pipeline.status()
+        encoder = self.pipeline.processing.encoder
+        # Варианты кадров (другое качество или ширина) читатели кодируют тем же кодировщиком и с теми же
+        # настройками JPEG, что и процесс захвата (FrameRingReader.encoder)
+        if encoder is not None:
+            status["ring_encoder"] = {"name": encoder.name, "jpeg": list(encoder.settings.key())}
+        return status
+
+    def _write_status(self):
+        while not self.stop_event.wait(RING_STATUS_INTERVAL):
+            status = self._status()
+            with self.writer_lock:
+                if self.writer is None:
+                    continue
+                status["ring_dropped"] = self.writer.dropped
+                self.writer.write_status(status)
+
+    def stop(self):
+        self.stop_event.set()
+        self.status_thread.join(timeout=RING_STATUS_INTERVAL * 2)
+        with self.writer_lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+
+def publish_ring_name(pipeline):
+    """Кольцо по умолчанию, если его не ведёт другой процесс захвата, иначе кольцо по серийному номеру.
+    Так /video_feed отдаёт камеру независимо от того, запущен ли процесс с id, а /video_feed/<id>
+    находит её в любом из двух колец (get_ring_camera)."""
+    if not ring_alive(ring_name()):
+        return ring_name()
+    return ring_name(pipeline.camera_id)
+
+
+def main():
+    camera_id = sys.argv[1] if len(sys.argv) > 1 else None
+    mode = sys.argv[2] if len(sys.argv) > 2 else ACQUISITION_POLLING
+    if mode not in (ACQUISITION_POLLING, ACQUISITION_CALLBACK):
+        raise SystemExit(f"Unknown acquisition mode: {mode}")
+
+    pipeline = init_camera(camera_id, mode)
+    pipeline.start_capture()
+    ring = publish_ring_name(pipeline)
+    publisher = RingPublisher(pipeline, ring)
+    publisher.start()
+    print(f"Capturing {pipeline.camera_id} into {ring}, Ctrl+C to stop")
+    try:
+        while publisher.is_alive():
+            publisher.join(timeout=1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Сначала закрываем камеру (подписка publisher завершится), затем кольцо — читатели увидят closed
+        close_camera(pipeline.camera_id)
+        publisher.join(timeout=5)
+        publisher.stop()
+
+
+if __name__ == "__main__":
+    main()
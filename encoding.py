@@ -0,0 +1,488 @@
+# JPEG-кодирование кадров: сменные кодировщики и пул процессов (без зависимостей от SDK)
+import io
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import cv2
+
+from image_processing import StageTimer
+
+# Необязательные кодировщики: используются, если установлены
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# Настройки JPEG по умолчанию
+JPEG_QUALITY = 80
+JPEG_SUBSAMPLING = "420"           # Прореживание цветности: 444 | 422 | 420 (для моно не важно)
+JPEG_PROGRESSIVE = False
+JPEG_OPTIMIZE = False
+ENCODER_BENCH_FRAMES = 10          # Кадров в стартовом замере каждого кодировщика
+
+ENCODER_OPENCV = "opencv"
+ENCODER_PIL = "pil"
+ENCODER_SIMPLEJPEG = "simplejpeg"
+SUBSAMPLING_MODES = ("444", "422", "420")
+
+# Поток MJPEG (multipart/x-mixed-replace)
+MJPEG_BOUNDARY = b"frame"
+MJPEG_MIMETYPE = f"multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY.decode()}"
+_MJPEG_PART_HEADER = b"--" + MJPEG_BOUNDARY + b"\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+_MJPEG_PART_TRAILER = b"\r\n"
+
+SLOTS_PER_WORKER = 2               # Буферов разделяемой памяти на один процесс кодирования
+WORKER_RESPONSE_TIMEOUT = 5.0      # Сколько ждать освобождения буферов при смене размера кадра, с
+ENCODE_TASK_TIMEOUT = 2.0          # Кадр без ответа дольше этого считается потерянным (процесс упал), с
+WORKER_CHECK_INTERVAL = 0.5        # Как часто сборщик проверяет процессы и зависшие кадры, с
+
+
+class JpegSettings:
+    """Параметры JPEG, общие для всех кодировщиков (передаются и в процессы пула)"""
+
+    def __init__(self, quality=JPEG_QUALITY, subsampling=JPEG_SUBSAMPLING, progressive=JPEG_PROGRESSIVE,
+                 optimize=JPEG_OPTIMIZE):
+        if not 1 <= quality <= 100:
+            raise ValueError("JPEG quality must be in 1..100")
+        if subsampling not in SUBSAMPLING_MODES:
+            raise ValueError(f"JPEG subsampling must be one of {SUBSAMPLING_MODES}")
+        self.quality = int(quality)
+        self.subsampling = subsampling
+        self.progressive = bool(progressive)
+        self.optimize = bool(optimize)
+
+    def key(self):
+        return self.quality, self.subsampling, self.progressive, self.optimize
+
+    def status(self):
+        return {"quality": self.quality, "subsampling": self.subsampling, "progressive": self.progressive,
+                "optimize": self.optimize}
+
+
+class OpenCVEncoder:
+    name = ENCODER_OPENCV
+
+    def __init__(self, settings):
+        self.settings = settings
+        sampling = {"444": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_444, "422": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_422,
+                    "420": cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420}
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, settings.quality,
+                       cv2.IMWRITE_JPEG_PROGRESSIVE, int(settings.progressive),
+                       cv2.IMWRITE_JPEG_OPTIMIZE, int(settings.optimize),
+                       cv2.IMWRITE_JPEG_SAMPLING_FACTOR, sampling[settings.subsampling]]
+
+    def encode(self, image):
+        ok, jpeg = cv2.imencode('.jpg', image, self.params)
+        return jpeg.tobytes() if ok else None
+
+
+class PILEncoder:
+    """Pillow (libjpeg-turbo в сборках Pillow-SIMD и в колёсах Pillow)"""
+    name = ENCODER_PIL
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.subsampling = {"444": 0, "422": 1, "420": 2}[settings.subsampling]
+
+    def encode(self, image):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        output = io.BytesIO()
+        Image.fromarray(image).save(output, format="JPEG", quality=self.settings.quality,
+                                    subsampling=self.subsampling, progressive=self.settings.progressive,
+                                    optimize=self.settings.optimize)
+        return output.getvalue()
+
+
+class SimpleJpegEncoder:
+    """simplejpeg (libjpeg-turbo без копий); progressive/optimize не поддерживает"""
+    name = ENCODER_SIMPLEJPEG
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def encode(self, image):
+        if image.ndim == 2:
+            return simplejpeg.encode_jpeg(image[:, :, None], self.settings.quality, colorspace="GRAY",
+                                          colorsubsampling="Gray")
+        return simplejpeg.encode_jpeg(image, self.settings.quality, colorspace="BGR",
+                                      colorsubsampling=self.settings.subsampling)
+
+
+ENCODERS = {
+    ENCODER_OPENCV: OpenCVEncoder,
+    ENCODER_PIL: PILEncoder,
+    ENCODER_SIMPLEJPEG: SimpleJpegEncoder,
+}
+
+
+def available_encoders():
+    available = [ENCODER_OPENCV]
+    if Image is not None:
+        available.append(ENCODER_PIL)
+    if simplejpeg is not None:
+        available.append(ENCODER_SIMPLEJPEG)
+    return available
+
+
+def make_encoder(name=ENCODER_OPENCV, settings=None):
+    if name not in available_encoders():
+        raise ValueError(f"JPEG encoder is not available: {name}")
+    return ENCODERS[name](settings or JpegSettings())
+
+
+def benchmark_encoder(encoder, shape, frames=ENCODER_BENCH_FRAMES):
+    """Кадров в секунду на синтетическом кадре заданного размера"""
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, shape[1], dtype=np.float32)
+    noise = rng.normal(0, 8, shape[:2]).astype(np.float32)
+    image = np.clip(gradient[None, :] + noise, 0, 255).astype(np.uint8)
+    if len(shape) == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    encoder.encode(image)  # прогрев
+    start = time.perf_counter()
+    for _ in range(frames):
+        encoder.encode(image)
+    return frames / max(time.perf_counter() - start, 1e-9)
+
+
+_selected_encoders = {}
+
+
+def select_encoder(shape, settings=None):
+    """Самый быстрый из установленных кодировщиков для кадра shape (замер один раз на размер)"""
+    settings = settings or JpegSettings()
+    cache_key = (tuple(shape), settings.key())
+    name = _selected_encoders.get(cache_key)
+    if name is None:
+        results = {}
+        for candidate in available_encoders():
+            results[candidate] = benchmark_encoder(make_encoder(candidate, settings), shape)
+        name = max(results, key=results.get)
+        _selected_encoders[cache_key] = name
+        summary = ", ".join(f"{candidate} {fps:.1f} fps" for candidate, fps in results.items())
+        print(f"JPEG encoder for {shape[1]}x{shape[0]}: {name} ({summary})")
+    return make_encoder(name, settings)
+
+
+def mjpeg_part(jpeg):
+    """Части одного кадра MJPEG: заголовок с Content-Length, данные и хвост.
+    Данные не склеиваются с заголовком — кадр не копируется лишний раз."""
+    return _MJPEG_PART_HEADER % len(jpeg), jpeg, _MJPEG_PART_TRAILER
+
+
+def mjpeg_stream(jpegs):
+    """Поток MJPEG из последовательности JPEG (bytes)"""
+    for jpeg in jpegs:
+        yield from mjpeg_part(jpeg)
+
+
+_attach_lock = threading.Lock()
+
+
+def attach_shared_memory(name):
+    """Подключение к чужому сегменту без регистрации в resource_tracker процесса.
+
+    До Python 3.13 подключение регистрирует сегмент в трекере, и тот удаляет
+    сегмент при выходе подключившегося процесса. Снимать регистрацию после
+    подключения нельзя: у дочернего процесса трекер может быть общий с
+    создателем сегмента.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _encode_worker(tasks, results):
+    """Процесс кодирования: кадр из разделяемой памяти -> JPEG (bytes)"""
+    segments = {}
+    generation = 0
+    encoders = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        seq, slot, name, task_generation, shape, encoder_spec = task
+
+        # Новое поколение буферов — старые сегменты больше не понадобятся
+        if task_generation != generation:
+            for segment in segments.values():
+                segment.close()
+            segments = {}
+            generation = task_generation
+        start = time.perf_counter()
+        jpeg = None
+        try:
+            segment = segments.get(name)
+            if segment is None:
+                segment = segments[name] = attach_shared_memory(name)
+
+            encoder = encoders.get(encoder_spec)
+            if encoder is None:
+                encoder_name, settings_key = encoder_spec
+                encoder = encoders[encoder_spec] = make_encoder(encoder_name, JpegSettings(*settings_key))
+
+            image = np.ndarray(shape, dtype=np.uint8, buffer=segment.buf)
+            try:
+                jpeg = encoder.encode(image)
+            finally:
+                del image  # иначе сегмент нельзя будет закрыть
+        except Exception as e:
+            # Ответ нужен в любом случае: сборщик выдаёт кадры строго по порядку и ждёт этот
+            print(f"Warning: JPEG encoding of frame {seq} failed: {e}")
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        results.put((seq, slot, jpeg, elapsed_ms))
+
+    for segment in segments.values():
+        segment.close()
+
+
+class EncoderPool:
+    """Кодирование JPEG в нескольких процессах в обход GIL.
+
+    submit() копирует кадр в свободный буфер разделяемой памяти (это же
+    отвязывает его от памяти SDK) и ставит задачу в очередь процессов.
+    Поток-сборщик принимает готовые JPEG и вызывает колбэки строго в порядке
+    отправки кадров. Если все буферы заняты, кадр отбрасывается — поток
+    захвата не ждёт кодировщиков. Кадр, на который процесс не ответил за
+    ENCODE_TASK_TIMEOUT, пропускается (его буфер возвращается), а упавшие
+    процессы сборщик заменяет новыми.
+    """
+
+    def __init__(self, workers, encoder=None, slots=None):
+        if workers < 1:
+            raise ValueError("Encoder pool needs at least one worker")
+        self.workers = workers
+        self.encoder = encoder or make_encoder()
+        self.slots = slots or workers * SLOTS_PER_WORKER
+        self.dropped = 0
+        self.encoded = 0
+        self.failed = 0
+        self.lost = 0
+        self.respawned = 0
+        self.callback_errors = 0
+        self.timer = StageTimer()
+
+        context = multiprocessing.get_context()
+        self._context = context
+        self._results = context.Queue()
+        self._free = queue.Queue()
+        self._segments = []
+        self._slot_bytes = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        # submit() и close() не пересекаются: пул не закрывается посреди копирования кадра
+        self._submit_lock = threading.Lock()
+        self._closed = False
+        self._callbacks = {}
+        # Номер кадра -> (буфер, время отправки, процесс), пока процесс не ответил
+        self._pending = {}
+        self._ready = {}
+        self._next_submit = 0
+        self._next_deliver = 0
+
+        # У каждого процесса своя очередь задач: процесс, убитый в ожидании общей очереди,
+        # унёс бы с собой её блокировку и остановил бы остальных
+        self._processes = [None] * workers
+        self._task_queues = [None] * workers
+        for index in range(workers):
+            self._start_worker(index)
+        self._collector = threading.Thread(target=self._collect, daemon=True, name="jpeg-collector")
+        self._collector.start()
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return len(self._callbacks)
+
+    def set_encoder(self, encoder):
+        """Кодировщик для следующих кадров; процессы создают его сами по имени и настройкам"""
+        self.encoder = encoder
+
+    def submit(self, image, callback):
+        """Ставит кадр в очередь кодирования; callback(jpeg_bytes) придёт в порядке submit().
+        Возвращает False, если кадр отброшен (в том числе пулом, который уже закрыт)."""
+        image = np.ascontiguousarray(image)
+        with self._submit_lock:
+            if self._closed:
+                self.dropped += 1
+                return False
+            if image.nbytes > self._slot_bytes:
+                self._resize(image.nbytes)
+            try:
+                slot = self._free.get_nowait()
+            except queue.Empty:
+                self.dropped += 1
+                return False
+
+            segment = self._segments[slot]
+            buffer = np.ndarray(image.shape, dtype=np.uint8, buffer=segment.buf)
+            buffer[...] = image
+            del buffer
+
+            with self._lock:
+                seq = self._next_submit
+                self._next_submit += 1
+                self._callbacks[seq] = callback
+                # Наименее загруженный процесс
+                loads = [0] * self.workers
+                for _, _, index in self._pending.values():
+                    loads[index] += 1
+                worker = loads.index(min(loads))
+                self._pending[seq] = (slot, time.monotonic(), worker)
+            encoder_spec = (self.encoder.name, self.encoder.settings.key())
+            self._task_queues[worker].put((seq, slot, segment.name, self._generation, image.shape, encoder_spec))
+            return True
+
+    def close(self):
+        # Ждём submit(), который уже копирует кадр, и не пускаем новые
+        with self._submit_lock:
+            self._closed = True
+        for tasks in self._task_queues:
+            tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        self._results.put((None, None, None, 0.0))
+        self._collector.join(timeout=2)
+        self._release_segments()
+
+    def status(self):
+        return {
+            "workers": self.workers,
+            "encoder": self.encoder.name,
+            "alive": sum(1 for process in self._processes if process.is_alive()),
+            "slots": self.slots,
+            "in_flight": self.in_flight,
+            "encoded": self.encoded,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "lost": self.lost,
+            "respawned": self.respawned,
+            "callback_errors": self.callback_errors,
+            "encode_time": self.timer.status()
+        }
+
+    def _resize(self, nbytes):
+        """Пересоздаёт буферы под больший кадр, дождавшись возврата всех занятых"""
+        taken = []
+        try:
+            for _ in range(len(self._segments)):
+                taken.append(self._free.get(timeout=WORKER_RESPONSE_TIMEOUT))
+        except queue.Empty:
+            for slot in taken:
+                self._free.put(slot)
+            raise RuntimeError("Encoder workers are not responding")
+
+        self._release_segments()
+        self._segments = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(self.slots)]
+        self._slot_bytes = nbytes
+        self._generation += 1
+        for slot in range(self.slots):
+            self._free.put(slot)
+
+    def _release_segments(self):
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+        self._slot_bytes = 0
+
+    def _start_worker(self, index):
+        tasks = self._context.Queue()
+        process = self._context.Process(target=_encode_worker, args=(tasks, self._results), daemon=True,
+                                        name=f"jpeg-encoder-{index}")
+        process.start()
+        self._task_queues[index] = tasks
+        self._processes[index] = process
+
+    def _collect(self):
+        while True:
+            try:
+                result = self._results.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                result = None
+            if result is not None:
+                seq, slot, jpeg, elapsed_ms = result
+                if seq is None:
+                    return
+                self._finish(seq, slot, jpeg, elapsed_ms)
+            self._expire_tasks()
+            self._respawn_workers()
+            self._deliver()
+
+    def _finish(self, seq, slot, jpeg, elapsed_ms):
+        with self._lock:
+            # Ответ на уже пропущенный кадр: его буфер давно возвращён и, возможно, занят снова
+            if self._pending.pop(seq, None) is None:
+                return
+            self._ready[seq] = jpeg
+        self._free.put(slot)
+        if jpeg is None:
+            self.failed += 1
+        else:
+            self.timer.record(elapsed_ms)
+
+    def _expire_tasks(self, worker=None):
+        """Кадры без ответа дольше ENCODE_TASK_TIMEOUT (или все кадры упавшего процесса worker)
+        пропускаем, иначе выдача по порядку встанет"""
+        now = time.monotonic()
+        expired = []
+        with self._lock:
+            for seq, (slot, submitted, index) in list(self._pending.items()):
+                if index == worker or now - submitted > ENCODE_TASK_TIMEOUT:
+                    del self._pending[seq]
+                    self._ready[seq] = None
+                    expired.append(slot)
+        for slot in expired:
+            self._free.put(slot)
+        self.lost += len(expired)
+
+    def _respawn_workers(self):
+        if self._closed:
+            return
+        for index, process in enumerate(self._processes):
+            if not process.is_alive():
+                print(f"Warning: JPEG encoder worker {process.name} exited with code {process.exitcode}; restarting")
+                old_tasks = self._task_queues[index]
+                self._start_worker(index)
+                self._expire_tasks(worker=index)
+                # Непрочитанные задачи мёртвого процесса не должны держать выход из программы
+                old_tasks.cancel_join_thread()
+                old_tasks.close()
+                self.respawned += 1
+
+    def _deliver(self):
+        # Выдаём кадры строго по порядку, даже если процессы закончили вразнобой
+        with self._lock:
+            delivered = []
+            while self._next_deliver in self._ready:
+                delivered.append((self._ready.pop(self._next_deliver),
+                                  self._callbacks.pop(self._next_deliver)))
+                self._next_deliver += 1
+        for jpeg, callback in delivered:
+            if jpeg is not None:
+                self.encoded += 1
+                # Исключение зрителя не должно остановить сборщик — иначе пул молча перестанет выдавать кадры
+                try:
+                    callback(jpeg)
+                except Exception as e:
+                    self.callback_errors += 1
+                    print(f"Warning: delivering encoded frame failed: {e!r}")
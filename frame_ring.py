@@ -0,0 +1,359 @@
+# Кольцо кадров в разделяемой памяти: процесс захвата пишет, процессы веб-сервера читают
+import json
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import cv2
+
+from encoding import ENCODER_OPENCV, JpegSettings, attach_shared_memory, available_encoders, make_encoder
+
+FRAME_RING_PREFIX = "mvcam"        # Имя кольца: префикс или префикс-<camera_id>
+RING_SLOTS = 8                     # Кадров в кольце — запас, чтобы читатель не терял кадр при копировании
+RING_JPEG_MARGIN = 65536           # Запас места под JPEG сверх размера несжатого кадра, байт
+RING_STATUS_BYTES = 65536          # Место под JSON-статус камеры
+RING_STATUS_INTERVAL = 1.0         # Как часто процесс захвата обновляет статус, с
+RING_POLL_INTERVAL = 0.005         # Опрос номера последнего кадра, пока кадры идут, с
+RING_IDLE_AFTER = 0.5              # Столько без новых кадров — опрос постепенно реже, с
+RING_IDLE_POLL_INTERVAL = 0.05     # Самый редкий опрос при простое, с
+RING_STALE_AFTER = 5.0             # Статус не обновлялся столько — процесс захвата считается упавшим, с
+
+RING_MAGIC = b"MVRING01"
+
+# Заголовок: magic, слотов, ёмкость JPEG, ёмкость кадра, epoch, последний кадр, закрыто,
+# длина статуса, номер версии статуса (нечётный — статус пишется), время последнего статуса (monotonic)
+_HEADER = struct.Struct("<8sIQQQQIIQd")
+# Слот: номер кадра (0 — слот пишется), длина JPEG, время захвата, высота, ширина, каналы
+_SLOT = struct.Struct("<QQdIII")
+_LATEST_OFFSET = struct.calcsize("<8sIQQQ")
+_CLOSED_OFFSET = _LATEST_OFFSET + 8
+_STATUS_LEN_OFFSET = _CLOSED_OFFSET + 4
+_STATUS_SEQ_OFFSET = _STATUS_LEN_OFFSET + 4
+_HEARTBEAT_OFFSET = _STATUS_SEQ_OFFSET + 8
+_STATUS_OFFSET = _HEADER.size
+_SLOTS_OFFSET = _STATUS_OFFSET + RING_STATUS_BYTES
+
+
+def ring_name(camera_id=None):
+    return f"{FRAME_RING_PREFIX}-{camera_id}" if camera_id else FRAME_RING_PREFIX
+
+
+def ring_alive(name):
+    """Кольцо есть и процесс захвата его ведёт"""
+    try:
+        reader = FrameRingReader(name)
+    except (FileNotFoundError, ValueError):
+        return False
+    alive = not reader.closed
+    reader.close()
+    return alive
+
+
+class PollBackoff:
+    """Интервал опроса кольца: RING_POLL_INTERVAL, пока идут кадры, и вдвое
+    реже на каждый пустой опрос после RING_IDLE_AFTER простоя"""
+
+    def __init__(self):
+        self.interval = RING_POLL_INTERVAL
+        self.last_change = time.monotonic()
+
+    def next(self, changed):
+        now = time.monotonic()
+        if changed:
+            self.last_change = now
+            self.interval = RING_POLL_INTERVAL
+        elif now - self.last_change > RING_IDLE_AFTER:
+            self.interval = min(self.interval * 2, RING_IDLE_POLL_INTERVAL)
+        return self.interval
+
+
+def _slot_size(jpeg_capacity, image_capacity):
+    return _SLOT.size + jpeg_capacity + image_capacity
+
+
+class FrameRingWriter:
+    """Публикация кадров в кольцо (только процесс захвата).
+
+    Слот пишется по схеме seqlock: номер кадра в слоте обнуляется, данные
+    копируются, затем номер выставляется и обновляется номер последнего
+    кадра. Кадр больше ёмкости слота не публикуется (dropped).
+    """
+
+    def __init__(self, name, jpeg_capacity, image_capacity, slots=RING_SLOTS):
+        self.name = name
+        self.slots = slots
+        self.jpeg_capacity = jpeg_capacity
+        self.image_capacity = image_capacity
+        self.dropped = 0
+        self._seq = 0
+        self._status_seq = 0
+        size = _SLOTS_OFFSET + slots * _slot_size(jpeg_capacity, image_capacity)
+
+        # Сегмент от упавшего процесса захвата с тем же именем больше никому не нужен
+        try:
+            stale = attach_shared_memory(name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _HEADER.pack_into(self._shm.buf, 0, RING_MAGIC, slots, jpeg_capacity, image_capacity, time.time_ns(),
+                          0, 0, 0, 0, time.monotonic())
+
+    @classmethod
+    def for_shape(cls, name, shape, slots=RING_SLOTS):
+        """Кольцо, в которое помещается кадр (uint8) такой формы"""
+        image_capacity = int(np.prod(shape))
+        return cls(name, image_capacity + RING_JPEG_MARGIN, image_capacity, slots)
+
+    def fits(self, jpeg, image):
+        return len(jpeg) <= self.jpeg_capacity and image.nbytes <= self.image_capacity
+
+    def publish(self, jpeg, image, captured):
+        if not self.fits(jpeg, image):
+            self.dropped += 1
+            return
+        seq = self._seq + 1
+        buf = self._shm.buf
+        offset = _SLOTS_OFFSET + (seq % self.slots) * _slot_size(self.jpeg_capacity, self.image_capacity)
+        _SLOT.pack_into(buf, offset, 0, 0, 0.0, 0, 0, 0)
+
+        data_offset = offset + _SLOT.size
+        buf[data_offset:data_offset + len(jpeg)] = jpeg
+        image_offset = data_offset + self.jpeg_capacity
+        view = np.ndarray(image.shape, dtype=np.uint8, buffer=buf, offset=image_offset)
+        view[...] = image
+        del view
+
+        channels = image.shape[2] if image.ndim == 3 else 1
+        _SLOT.pack_into(buf, offset, seq, len(jpeg), captured, image.shape[0], image.shape[1], channels)
+        struct.pack_into("<Q", buf, _LATEST_OFFSET, seq)
+        self._seq = seq
+
+    def write_status(self, status):
+        data = json.dumps(status).encode()[:RING_STATUS_BYTES]
+        buf = self._shm.buf
+        self._status_seq += 1
+        struct.pack_into("<Q", buf, _STATUS_SEQ_OFFSET, self._status_seq * 2 - 1)
+        buf[_STATUS_OFFSET:_STATUS_OFFSET + len(data)] = data
+        struct.pack_into("<I", buf, _STATUS_LEN_OFFSET, len(data))
+        struct.pack_into("<Q", buf, _STATUS_SEQ_OFFSET, self._status_seq * 2)
+        struct.pack_into("<d", buf, _HEARTBEAT_OFFSET, time.monotonic())
+
+    def close(self):
+        struct.pack_into("<I", self._shm.buf, _CLOSED_OFFSET, 1)
+        self._shm.close()
+        self._shm.unlink()
+
+
+class RingFrame:
+    """Кадр из кольца с тем же интерфейсом, что у StreamFrame.
+
+    JPEG копируется при чтении (это сжатые данные); несжатый кадр остаётся в
+    разделяемой памяти и читается только для вариантов другого качества или
+    размера — с проверкой, что слот за это время не перезаписан.
+    """
+
+    def __init__(self, reader, seq, jpeg, captured, slot_offset, shape):
+        self.reader = reader
+        self.seq = seq
+        self.jpeg = jpeg
+        self.captured = captured
+        self._slot_offset = slot_offset
+        self._shape = shape
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    @property
+    def width(self):
+        return self._shape[1]
+
+    def variant(self, quality=None, width=None, encode=True):
+        # Как StreamFrame.variant: кодировщик и настройки JPEG процесса захвата
+        encoder = self.reader.encoder()
+        if quality == encoder.settings.quality:
+            quality = None
+        if width is not None and width >= self.width:
+            width = None
+        if quality is None and width is None:
+            return self.jpeg
+        key = (quality, width)
+        if not encode:
+            return self._variants.get(key)
+        with self._lock:
+            jpeg = self._variants.get(key)
+            if jpeg is None:
+                jpeg = self._variants[key] = self._encode_variant(encoder, quality, width)
+        return jpeg
+
+    def _encode_variant(self, encoder, quality, width):
+        image = self.reader.image_view(self._slot_offset, self._shape)
+        if width is not None:
+            height = max(round(self._shape[0] * width / self._shape[1]), 1)
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        else:
+            image = image.copy()
+        # Слот перезаписан, пока мы его читали, — отдаём исходный JPEG
+        if not self.reader.slot_valid(self._slot_offset, self.seq):
+            return self.jpeg
+        settings = encoder.settings
+        return make_encoder(encoder.name, JpegSettings(quality or settings.quality, settings.subsampling,
+                                                       settings.progressive, settings.optimize)).encode(image)
+
+
+class FrameRingReader:
+    """Чтение кольца из любого процесса; интерфейс как у FrameBroadcaster (subscribe, latest).
+
+    Номер последнего кадра опрашивает один поток на кольцо (PollBackoff), пока
+    есть подписчики; зрители subscribe() ждут его уведомления на self._cond.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._shm = attach_shared_memory(name)
+        magic, self.slots, self.jpeg_capacity, self.image_capacity, self.epoch, _, _, _, _, _ = \
+            _HEADER.unpack_from(self._shm.buf, 0)
+        if magic != RING_MAGIC:
+            self._shm.close()
+            raise ValueError(f"Not a frame ring: {name}")
+        self._slot_size = _slot_size(self.jpeg_capacity, self.image_capacity)
+        self._cache = None
+        self._lock = threading.Lock()
+        # Кодировщик процесса захвата и версия статуса, из которой он прочитан
+        self._encoder = None
+        self._encoder_seq = None
+        # Под self._cond: номер кадра, о котором уведомил поток опроса, подписчики, кольцо закрыто
+        self._cond = threading.Condition()
+        self._published = 0
+        self._subscribers = 0
+        self._finished = False
+        self._watcher = None
+
+    @property
+    def closed(self):
+        """Кольцо закрыто процессом захвата или тот перестал обновлять статус (упал).
+        CLOCK_MONOTONIC общий для всех процессов машины, поэтому время сравнимо."""
+        if struct.unpack_from("<I", self._shm.buf, _CLOSED_OFFSET)[0]:
+            return True
+        heartbeat = struct.unpack_from("<d", self._shm.buf, _HEARTBEAT_OFFSET)[0]
+        return time.monotonic() - heartbeat > RING_STALE_AFTER
+
+    @property
+    def latest_seq(self):
+        return struct.unpack_from("<Q", self._shm.buf, _LATEST_OFFSET)[0]
+
+    def read(self, seq):
+        """Кадр с номером seq или None, если слот уже перезаписан"""
+        with self._lock:
+            if self._cache is not None and self._cache.seq == seq:
+                return self._cache
+        buf = self._shm.buf
+        offset = _SLOTS_OFFSET + (seq % self.slots) * self._slot_size
+        slot_seq, length, captured, height, width, channels = _SLOT.unpack_from(buf, offset)
+        if slot_seq != seq:
+            return None
+        data_offset = offset + _SLOT.size
+        jpeg = bytes(buf[data_offset:data_offset + length])
+        if not self.slot_valid(offset, seq):
+            return None
+        shape = (height, width, channels) if channels > 1 else (height, width)
+        frame = RingFrame(self, seq, jpeg, captured, offset, shape)
+        # Один объект кадра на всех зрителей процесса — варианты кодируются один раз
+        with self._lock:
+            self._cache = frame
+        return frame
+
+    def latest(self):
+        seq = self.latest_seq
+        return self.read(seq) if seq else None
+
+    def subscribe(self):
+        """Новые кадры для одного зрителя; завершается, когда процесс захвата закрыл кольцо"""
+        cursor = 0
+        with self._cond:
+            self._subscribers += 1
+            if self._watcher is None and not self._finished:
+                self._published = self.latest_seq
+                self._watcher = threading.Thread(target=self._watch, daemon=True, name=f"ring-watch-{self.name}")
+                self._watcher.start()
+        try:
+            while True:
+                with self._cond:
+                    while self._published == cursor and not self._finished:
+                        self._cond.wait()
+                    if self._published == cursor:
+                        return
+                    cursor = self._published
+                # Слот уже перезаписан (зритель отстал) — ждём следующий кадр
+                frame = self.read(cursor)
+                if frame is not None:
+                    yield frame
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+    def _watch(self):
+        """Поток опроса: будит подписчиков на новый кадр; без подписчиков завершается"""
+        backoff = PollBackoff()
+        while True:
+            closed = self.closed
+            seq = self.latest_seq
+            with self._cond:
+                changed = seq != self._published
+                if changed:
+                    self._published = seq
+                    self._cond.notify_all()
+                if closed:
+                    self._finished = True
+                    self._cond.notify_all()
+                if closed or not self._subscribers:
+                    self._watcher = None
+                    return
+            time.sleep(backoff.next(changed))
+
+    def slot_valid(self, slot_offset, seq):
+        return struct.unpack_from("<Q", self._shm.buf, slot_offset)[0] == seq
+
+    def image_view(self, slot_offset, shape):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self._shm.buf,
+                          offset=slot_offset + _SLOT.size + self.jpeg_capacity)
+
+    def encoder(self):
+        """Кодировщик, которым процесс захвата кодирует кадры (ring_encoder в статусе).
+        Статус перечитывается только после его обновления; пока он пишется — прежний кодировщик"""
+        status_seq = struct.unpack_from("<Q", self._shm.buf, _STATUS_SEQ_OFFSET)[0]
+        with self._lock:
+            if self._encoder is not None and (status_seq == self._encoder_seq or status_seq % 2):
+                return self._encoder
+        spec = self.status().get("ring_encoder") or {}
+        name = spec.get("name")
+        # Кодировщика процесса захвата может не быть здесь (например, без simplejpeg) — тогда OpenCV
+        if name not in available_encoders():
+            name = ENCODER_OPENCV
+        try:
+            settings = JpegSettings(*spec.get("jpeg", ()))
+        except (TypeError, ValueError):
+            settings = JpegSettings()
+        encoder = make_encoder(name, settings)
+        with self._lock:
+            self._encoder, self._encoder_seq = encoder, status_seq
+        return encoder
+
+    def close(self):
+        self._shm.close()
+
+    def status(self):
+        """Последний статус камеры, записанный процессом захвата"""
+        buf = self._shm.buf
+        for _ in range(3):
+            before = struct.unpack_from("<Q", buf, _STATUS_SEQ_OFFSET)[0]
+            if before % 2:
+                time.sleep(RING_POLL_INTERVAL)
+                continue
+            length = struct.unpack_from("<I", buf, _STATUS_LEN_OFFSET)[0]
+            data = bytes(buf[_STATUS_OFFSET:_STATUS_OFFSET + length])
+            if struct.unpack_from("<Q", buf, _STATUS_SEQ_OFFSET)[0] == before:
+                return json.loads(data) if data else {}
+        return {}
@@ -0,0 +1,627 @@
+# Обработка кадров камеры без зависимостей от SDK (можно импортировать и тестировать отдельно)
+import math
+import threading
+import time
+
+import numpy as np
+import cv2
+
+# Глобальные переменные для управления экспозицией
+TARGET_BRIGHTNESS = 60.0           # Целевая яркость (0-255)
+INITIAL_EXPOSURE = 30000.0         # Стартовая экспозиция (высокая для темноты)
+MIN_EXPOSURE = 20000.0             # Минимальная экспозиция (не даём опускаться ниже уровня для темноты)
+MAX_EXPOSURE = 100000.0            # Максимальная экспозиция
+SMOOTHING_FACTOR_UP = 0.05         # Плавность при увеличении экспозиции (для темноты)
+SMOOTHING_FACTOR_DOWN = 0.01       # Плавность при уменьшении (для света, очень медленно)
+DARK_BRIGHTNESS = 30.0             # Ниже этой яркости добавляется выравнивание гистограммы
+EXPOSURE_DEADBAND = 0.02           # Относительное изменение, меньше которого в камеру не пишем
+EXPOSURE_MIN_INTERVAL = 0.1        # Не чаще одной записи ExposureTime за этот интервал, с
+SENSOR_READOUT_US = 3000.0         # Время считывания сенсора, вычитается из периода кадра, мкс
+MAX_GAIN_DB = 12.0                 # Потолок аналогового усиления при нехватке экспозиции, дБ
+
+# Замер яркости по каждому METER_STRIDE-му пикселю в строке и столбце
+METER_STRIDE = 4
+METER_STRIDES = (4, 8)
+
+# Режимы замера: среднее по кадру, центровзвешенный, с весом пользовательской области
+METER_AVERAGE = "average"
+METER_CENTER = "center"
+METER_ROI = "roi"
+METER_MODES = (METER_AVERAGE, METER_CENTER, METER_ROI)
+CENTER_WEIGHT = 4.0                # Вес центра кадра относительно краёв
+CENTER_SIGMA = 0.25                # Радиус центрального пятна, доля размера кадра
+ROI_WEIGHT = 4.0                   # Вес пользовательской области относительно остального кадра
+CLIP_LEVEL = 250                   # Уровень, начиная с которого пиксель считается пересвеченным
+CLIP_LIMIT = 0.02                  # Допустимая (взвешенная) доля пересвеченных пикселей
+
+# Временное шумоподавление: вес нового кадра в скользящем среднем и порог движения
+DENOISE_ALPHA = 0.3
+MOTION_THRESHOLD = 12.0            # Средняя разница кадра и накопителя (0-255), выше — сброс
+
+# Этапы обработки кадра по умолчанию (порядок важен); см. ProcessingPipeline
+STAGE_DENOISE = "denoise"
+STAGE_METER = "meter"
+STAGE_TONE_MAP = "tone-map"
+STAGE_ROTATE = "rotate"
+STAGE_SCENE_GAIN = "scene-gain"
+STAGE_ENCODE = "encode"
+DEFAULT_STAGES = (STAGE_DENOISE, STAGE_METER, STAGE_TONE_MAP, STAGE_ENCODE)
+# Этапы, нужные только для отдачи кадра зрителям. Кадр, который не нужен ни одному зрителю
+# (?fps=), проходит лишь остальные этапы: замер и денойзер работают на частоте камеры
+OUTPUT_STAGES = frozenset((STAGE_TONE_MAP, STAGE_SCENE_GAIN, STAGE_ROTATE, STAGE_ENCODE))
+# Поворот кадра (этап rotate), градусы по часовой стрелке -> код cv2.rotate
+ROTATIONS = {
+    0: None,
+    90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+# Пороговая коррекция Pobochki/app.py (этап scene-gain): средняя яркость -> правило
+SCENE_DARK_MEAN = 30               # Темнее — выравнивание гистограммы
+SCENE_BRIGHT_MEAN = 200            # Светлее — ×0.7, между порогами — ×1.2 + 10
+# Границы корзин гистограммы времени этапа, мс (последняя корзина — всё, что дольше)
+TIMING_BUCKETS_MS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0)
+
+_IDENTITY = np.arange(256, dtype=np.float32)
+
+
+class ExposureController:
+    """Программная экспозиция одной камеры.
+
+    feed() вызывается из цикла кадров: он только пересчитывает экспозицию по
+    замеру яркости и будит поток управления. Запись в камеру (регистр GenICam
+    через GVCP) делает отдельный поток и только если значение ушло от
+    записанного больше чем на мёртвую зону, не чаще раза в min_interval.
+    Без start() контроллер лишь считает экспозицию и ничего не пишет.
+
+    С target_fps экспозиция не превышает 1/fps минус время считывания, а
+    недостающую яркость добирает усиление (Gain, дБ): current — это требуемая
+    «эквивалентная» экспозиция, split() делит её на выдержку и усиление.
+    """
+
+    def __init__(self, initial=INITIAL_EXPOSURE, deadband=EXPOSURE_DEADBAND, min_interval=EXPOSURE_MIN_INTERVAL):
+        self.current = initial
+        self.applied = None
+        self.deadband = deadband
+        self.min_interval = min_interval
+        self.writes = 0
+        self.target_fps = None
+        self.readout_us = SENSOR_READOUT_US
+        self.max_gain_db = MAX_GAIN_DB
+        self.fps = 0.0
+        self._write = None
+        self._write_gain = None
+        self._last_write = 0.0
+        self._frame_count = 0
+        self._fps_started = time.monotonic()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = True
+
+    def feed(self, current_brightness):
+        """Замер яркости кадра; возвращает ошибку яркости относительно цели"""
+        with self._cond:
+            low, high = self.limits()
+            error = update_exposure(self, current_brightness, low, high)
+            if self._write is not None:
+                self._cond.notify()
+
+            # Фактическая частота кадров — по частоте замеров
+            self._frame_count += 1
+            elapsed = time.monotonic() - self._fps_started
+            if elapsed >= 1.0:
+                self.fps = self._frame_count / elapsed
+                self._frame_count = 0
+                self._fps_started = time.monotonic()
+        return error
+
+    def configure(self, target_fps=None, readout_us=None, max_gain_db=None):
+        """Целевая частота кадров (None — без ограничения выдержки)"""
+        with self._cond:
+            self.target_fps = target_fps
+            if readout_us is not None:
+                self.readout_us = readout_us
+            if max_gain_db is not None:
+                self.max_gain_db = max_gain_db
+            low, high = self.limits()
+            self.current = min(max(self.current, low), high)
+            self._cond.notify()
+
+    def exposure_limit(self):
+        """Максимальная выдержка, при которой камера ещё успевает target_fps"""
+        if not self.target_fps:
+            return MAX_EXPOSURE
+        frame_period = 1e6 / self.target_fps - self.readout_us
+        return max(min(frame_period, MAX_EXPOSURE), 1.0)
+
+    def limits(self):
+        """Допустимый диапазон эквивалентной экспозиции"""
+        limit = self.exposure_limit()
+        if not self.target_fps:
+            return MIN_EXPOSURE, MAX_EXPOSURE
+        return min(MIN_EXPOSURE, limit), limit * 10 ** (self.max_gain_db / 20.0)
+
+    def split(self, value):
+        """Эквивалентная экспозиция -> (выдержка, мкс; усиление, дБ)"""
+        exposure_us = min(value, self.exposure_limit())
+        gain_db = 20.0 * math.log10(value / exposure_us) if value > exposure_us else 0.0
+        return exposure_us, min(gain_db, self.max_gain_db)
+
+    def start(self, write, write_gain=None):
+        """write(us) — запись ExposureTime, write_gain(dB) — запись Gain.
+        Вызываются только из потока контроллера."""
+        self.stop()
+        with self._cond:
+            self._write = write
+            self._write_gain = write_gain
+            self._stopped = False
+            self.applied = None
+        self._thread = threading.Thread(target=self._run, daemon=True, name="exposure-control")
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._write = None
+            self._write_gain = None
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2)
+        self._thread = None
+
+    def status(self):
+        exposure_us, gain_db = self.split(self.current)
+        return {
+            "current": round(self.current, 1),
+            "applied": self.applied,
+            "writes": self.writes,
+            "exposure_us": round(exposure_us, 1),
+            "gain_db": round(gain_db, 2),
+            "target_fps": self.target_fps,
+            "exposure_limit_us": round(self.exposure_limit(), 1),
+            "fps": round(self.fps, 1)
+        }
+
+    def _needs_write(self):
+        if self.applied is None:
+            return True
+        return abs(self.current - self.applied) > self.deadband * self.applied
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopped or self._needs_write())
+                if self._stopped:
+                    return
+                wait = self._last_write + self.min_interval - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                value = self.current
+                write, write_gain = self._write, self._write_gain
+
+            exposure_us, gain_db = self.split(value)
+            write(exposure_us)
+            if write_gain is not None:
+                write_gain(gain_db)
+
+            with self._cond:
+                self.applied = value
+                self._last_write = time.monotonic()
+                self.writes += 1
+
+
+def meter_subsample(img, stride=METER_STRIDE):
+    """Прореженное представление кадра для замера (view, без копирования)"""
+    return img[::stride, ::stride]
+
+
+class Meter:
+    """Замер яркости по гистограмме прореженного кадра.
+
+    Центровзвешенный режим и режим ROI взвешивают гистограмму картой весов,
+    которая строится один раз под размер прореженного кадра. ROI задаётся
+    долями кадра (x, y, w, h), поэтому не зависит от пресета захвата.
+    Если доля пересвеченных пикселей больше CLIP_LIMIT, замер завышается —
+    контроллер уводит экспозицию вниз, даже когда средняя яркость в норме.
+    """
+
+    def __init__(self, mode=METER_AVERAGE, stride=METER_STRIDE, roi=None, clip_limit=CLIP_LIMIT):
+        self.configure(mode, stride, roi, clip_limit)
+
+    def configure(self, mode=METER_AVERAGE, stride=METER_STRIDE, roi=None, clip_limit=CLIP_LIMIT):
+        if mode not in METER_MODES:
+            raise ValueError(f"Unknown metering mode: {mode}")
+        if stride not in METER_STRIDES:
+            raise ValueError(f"Metering stride must be one of {METER_STRIDES}")
+        if mode == METER_ROI:
+            if roi is None:
+                raise ValueError("Metering ROI is required")
+            x, y, w, h = roi
+            if not (0 <= x < 1 and 0 <= y < 1 and 0 < w <= 1 - x and 0 < h <= 1 - y):
+                raise ValueError("Metering ROI must be fractions of the frame")
+        # Настройки меняются одним присваиванием — цикл кадров читает их без блокировки
+        self.settings = (mode, stride, tuple(roi) if roi is not None else None, clip_limit)
+        self._weights = None
+
+    def status(self):
+        mode, stride, roi, clip_limit = self.settings
+        return {"mode": mode, "stride": stride, "roi": roi, "clip_limit": clip_limit}
+
+    def weights(self, shape, settings):
+        """Карта весов под прореженный кадр (None для среднего по кадру)"""
+        cached = self._weights
+        if cached is not None and cached[0] == (shape, settings):
+            return cached[1]
+        mode, _, roi, _ = settings
+        if mode == METER_AVERAGE:
+            weights = None
+        elif mode == METER_CENTER:
+            rows = np.linspace(-0.5, 0.5, shape[0], dtype=np.float32)
+            cols = np.linspace(-0.5, 0.5, shape[1], dtype=np.float32)
+            r2 = rows[:, None] ** 2 + cols[None, :] ** 2
+            weights = 1.0 + (CENTER_WEIGHT - 1.0) * np.exp(-r2 / (2 * CENTER_SIGMA ** 2))
+        else:
+            x, y, w, h = roi
+            weights = np.ones(shape, dtype=np.float32)
+            top, left = int(y * shape[0]), int(x * shape[1])
+            bottom, right = max(int((y + h) * shape[0]), top + 1), max(int((x + w) * shape[1]), left + 1)
+            weights[top:bottom, left:right] = ROI_WEIGHT
+        if weights is not None:
+            weights = np.ascontiguousarray(weights, dtype=np.float64).ravel()
+        self._weights = ((shape, settings), weights)
+        return weights
+
+    def measure(self, img):
+        """Возвращает (яркость для контроллера, гистограмма прореженного кадра)"""
+        settings = self.settings
+        _, stride, _, clip_limit = settings
+        sample = meter_subsample(img, stride)
+        values = sample.ravel()
+        hist = np.bincount(values, minlength=256)
+
+        weights = self.weights(sample.shape, settings)
+        weighted = hist if weights is None else np.bincount(values, weights=weights, minlength=256)
+        total = max(float(weighted.sum()), 1.0)
+        brightness = float(np.dot(weighted, _IDENTITY)) / total
+
+        # Защита светов: превышение доли пересвета поднимает замер над целью
+        clipped = float(weighted[CLIP_LEVEL:].sum()) / total
+        if clipped > clip_limit:
+            brightness = max(brightness, TARGET_BRIGHTNESS + (clipped - clip_limit) * 255.0)
+        return brightness, hist
+
+
+DEFAULT_METER = Meter()
+
+
+def gain_lut(gain):
+    """Таблица, эквивалентная cv2.convertScaleAbs(img, alpha=gain, beta=0)"""
+    return np.clip(np.rint(_IDENTITY * gain), 0, 255).astype(np.uint8)
+
+
+def equalize_lut(hist):
+    """Таблица выравнивания по гистограмме — та же формула, что в cv2.equalizeHist"""
+    hist = np.asarray(hist, dtype=np.float64)
+    total = hist.sum()
+    nonzero = np.flatnonzero(hist)
+    if total == 0 or len(nonzero) == 0:
+        return np.arange(256, dtype=np.uint8)
+    first = nonzero[0]
+    if hist[first] == total:
+        return np.full(256, first, dtype=np.uint8)
+
+    scale = 255.0 / (total - hist[first])
+    cdf = np.cumsum(hist)
+    lut = np.rint((cdf - hist[first]) * scale)
+    lut[:first + 1] = 0
+    return np.clip(lut, 0, 255).astype(np.uint8)
+
+
+class TemporalDenoiser:
+    """Скользящее среднее кадров (cv2.accumulateWeighted) для съёмки в темноте.
+
+    Накопитель float32 и выходной 8-битный буфер выделяются один раз под
+    размер кадра. Если кадр заметно отличается от накопителя (движение или
+    смена сцены), накопитель сбрасывается на текущий кадр — без шлейфов.
+    Выключенный денойзер возвращает кадр как есть.
+    """
+
+    def __init__(self, alpha=DENOISE_ALPHA, motion_threshold=MOTION_THRESHOLD):
+        self.enabled = False
+        self.alpha = alpha
+        self.motion_threshold = motion_threshold
+        self.resets = 0
+        self._acc = None
+        self._out = None
+
+    def configure(self, enabled, alpha=None, motion_threshold=None):
+        if alpha is not None:
+            if not 0 < alpha <= 1:
+                raise ValueError("Denoise alpha must be in (0, 1]")
+            self.alpha = alpha
+        if motion_threshold is not None:
+            self.motion_threshold = motion_threshold
+        # Накопитель заполнится первым кадром после включения
+        self._acc = None
+        self.enabled = enabled
+
+    def status(self):
+        return {"enabled": self.enabled, "alpha": self.alpha, "motion_threshold": self.motion_threshold,
+                "resets": self.resets}
+
+    def apply(self, img):
+        """Кадр после усреднения; результат — собственный буфер, не память SDK"""
+        if not self.enabled:
+            return img
+        acc = self._acc
+        if acc is None or acc.shape != img.shape:
+            acc = self._acc = np.empty(img.shape, dtype=np.float32)
+            self._out = np.empty(img.shape, dtype=np.uint8)
+            acc[...] = img
+        else:
+            # Движение оцениваем по прореженному кадру
+            sample = meter_subsample(img, METER_STRIDES[-1])
+            motion = float(np.mean(np.abs(sample - meter_subsample(acc, METER_STRIDES[-1]))))
+            if motion > self.motion_threshold:
+                acc[...] = img
+                self.resets += 1
+            else:
+                cv2.accumulateWeighted(img, acc, self.alpha)
+        return cv2.convertScaleAbs(acc, dst=self._out)
+
+
+def update_exposure(exposure, current_brightness, low=MIN_EXPOSURE, high=MAX_EXPOSURE):
+    """Асимметричная регулировка программной экспозиции; возвращает ошибку яркости"""
+    error = TARGET_BRIGHTNESS - current_brightness
+
+    # - Медленно уменьшаем экспозицию при светлых кадрах (SMOOTHING_FACTOR_DOWN)
+    # - Быстрее увеличиваем при тёмных (SMOOTHING_FACTOR_UP)
+    smoothing_factor = SMOOTHING_FACTOR_DOWN if error < 0 else SMOOTHING_FACTOR_UP
+    exposure_adjustment = error * smoothing_factor * 100
+
+    # Запрещаем экспозиции опускаться ниже нижней границы (MIN_EXPOSURE)
+    new_exposure = max(low, exposure.current + exposure_adjustment)
+    exposure.current = min(new_exposure, high)
+    return error
+
+
+def optimize_image(img, exposure, mono=False, meter=DEFAULT_METER):
+    """Коррекция яркости 8-битного кадра за один проход cv2.LUT.
+
+    Яркость и гистограмма считаются по прореженному кадру (см. Meter).
+    Усиление и (для тёмных кадров) выравнивание гистограммы сводятся в одну
+    таблицу на 256 значений. mono=True возвращает 8-битную плоскость — её
+    можно сразу отдавать в JPEG-кодер без расширения до BGR.
+
+    Это приближение к прежней последовательности mean + convertScaleAbs +
+    equalizeHist: по выборке среднее и гистограмма чуть другие, поэтому часть
+    пикселей отличается на 1 уровень (см. bench_optimize_image.py).
+    """
+    current_brightness, hist = meter.measure(img)
+    error = exposure.feed(current_brightness)
+    return tone_map(img, error, current_brightness, hist, mono)
+
+
+def tone_map(img, error, current_brightness, hist, mono=False):
+    """Применение коррекции по результатам замера (ошибка яркости и гистограмма)"""
+    # Лёгкая программная коррекция (без пересветов)
+    gain = 1.0 + (error / 255.0) * 0.2  # Очень мягкое усиление
+    lut = gain_lut(gain)
+
+    # Для тёмных кадров — гистограммное выравнивание поверх усиления
+    if current_brightness < DARK_BRIGHTNESS:
+        corrected_hist = np.bincount(lut, weights=hist, minlength=256)
+        lut = equalize_lut(corrected_hist)[lut]
+
+    img_corrected = cv2.LUT(img, lut)
+    if mono:
+        return img_corrected
+    return cv2.cvtColor(img_corrected, cv2.COLOR_GRAY2BGR)
+
+
+class StageTimer:
+    """Гистограмма времени выполнения одного этапа (корзины TIMING_BUCKETS_MS)"""
+
+    def __init__(self):
+        self.counts = [0] * (len(TIMING_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms):
+        bucket = 0
+        while bucket < len(TIMING_BUCKETS_MS) and elapsed_ms > TIMING_BUCKETS_MS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def status(self):
+        labels = [f"<={bound:g}ms" for bound in TIMING_BUCKETS_MS] + [f">{TIMING_BUCKETS_MS[-1]:g}ms"]
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "histogram": dict(zip(labels, list(self.counts)))
+        }
+
+
+class ProcessedFrame:
+    """Состояние кадра, которое этапы передают друг другу.
+
+    owned — image создан этапом обработки заново для этого кадра. Иначе он
+    указывает на буфер SDK или переиспользуемый буфер денойзера.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.owned = False
+        self.brightness = None
+        self.error = 0.0
+        self.hist = None
+        self.jpeg = None
+        self.on_encoded = None
+
+    def owned_image(self):
+        """Обработанный кадр, который можно хранить после выхода из run()"""
+        if not self.owned:
+            self.image = self.image.copy()
+            self.owned = True
+        return self.image
+
+
+def stage_denoise(processing, frame):
+    if processing.denoiser is not None:
+        frame.image = processing.denoiser.apply(frame.image)
+        frame.owned = False
+
+
+def stage_meter(processing, frame):
+    frame.brightness, frame.hist = processing.meter.measure(frame.image)
+    frame.error = processing.exposure.feed(frame.brightness)
+
+
+def stage_tone_map(processing, frame):
+    if frame.hist is None:
+        # Без этапа замера — только расширение до BGR, если нужно
+        if not processing.mono and frame.image.ndim == 2:
+            frame.image = cv2.cvtColor(frame.image, cv2.COLOR_GRAY2BGR)
+            frame.owned = True
+        return
+    frame.image = tone_map(frame.image, frame.error, frame.brightness, frame.hist, processing.mono)
+    frame.owned = True
+
+
+def stage_scene_gain(processing, frame):
+    # Прежняя обработка Pobochki/app.py как есть: среднее по всему кадру и три правила
+    current_mean = np.mean(frame.image)
+    if current_mean < SCENE_DARK_MEAN:
+        frame.image = cv2.equalizeHist(frame.image)
+    elif current_mean > SCENE_BRIGHT_MEAN:
+        frame.image = cv2.convertScaleAbs(frame.image, alpha=0.7, beta=0)
+    else:
+        frame.image = cv2.convertScaleAbs(frame.image, alpha=1.2, beta=10)
+    frame.owned = True
+
+
+def stage_rotate(processing, frame):
+    if processing.rotate is not None:
+        frame.image = cv2.rotate(frame.image, processing.rotate)
+        frame.owned = True
+
+
+def stage_encode(processing, frame):
+    # С пулом процессов кадр уходит на кодирование, результат придёт в on_encoded.
+    # Пул читаем один раз: /encode_workers может заменить его между проверкой и submit()
+    pool = processing.encode_pool
+    if pool is not None and frame.on_encoded is not None:
+        on_encoded, image = frame.on_encoded, frame.owned_image()
+        pool.submit(image, lambda jpeg: on_encoded(jpeg, image))
+        return
+    if processing.encoder is not None:
+        frame.jpeg = processing.encoder.encode(frame.image)
+        return
+    ok, jpeg = cv2.imencode('.jpg', frame.image)
+    frame.jpeg = jpeg.tobytes() if ok else None
+
+
+STAGES = {
+    STAGE_DENOISE: stage_denoise,
+    STAGE_METER: stage_meter,
+    STAGE_TONE_MAP: stage_tone_map,
+    STAGE_ROTATE: stage_rotate,
+    STAGE_SCENE_GAIN: stage_scene_gain,
+    STAGE_ENCODE: stage_encode,
+}
+
+
+def parse_stages(value):
+    """Список этапов из строки "denoise,meter,tone-map,encode" (пустая — без обработки)"""
+    return tuple(name.strip() for name in value.split(',') if name.strip())
+
+
+class ProcessingPipeline:
+    """Обработка кадра как последовательность именованных этапов.
+
+    Порядок этапов задаётся списком имён (STAGES) и меняется на ходу через
+    configure() — без правки циклов захвата. Каждый этап пишет своё время в
+    StageTimer, общее время кадра — в timings["total"].
+
+    encoder — кодировщик из encoding (без него cv2.imencode с настройками по
+    умолчанию); encode_pool (encoding.EncoderPool) выносит кодирование в процессы: тогда
+    JPEG приходит асинхронно в on_encoded, переданный в run().
+    """
+
+    def __init__(self, exposure, meter=DEFAULT_METER, denoiser=None, stages=DEFAULT_STAGES, mono=False,
+                 rotate=0, encoder=None):
+        self.exposure = exposure
+        self.meter = meter
+        self.denoiser = denoiser
+        self.mono = mono
+        self.encoder = encoder
+        self.encode_pool = None
+        self.timings = {"total": StageTimer()}
+        self.configure(stages)
+        self.set_rotation(rotate)
+
+    def configure(self, stages):
+        stages = tuple(stages)
+        for name in stages:
+            if name not in STAGES:
+                raise ValueError(f"Unknown processing stage: {name}")
+            self.timings.setdefault(name, StageTimer())
+        if len(set(stages)) != len(stages):
+            raise ValueError("Processing stages must not repeat")
+        # Цикл кадров читает кортеж целиком — замена атомарна
+        self.stages = stages
+
+    def set_rotation(self, degrees):
+        """Поворот кадра на 0/90/180/270° по часовой стрелке (этап rotate).
+        Поворот без этапа rotate ничего бы не делал — этап добавляется перед кодированием."""
+        if degrees not in ROTATIONS:
+            raise ValueError(f"Rotation must be one of {sorted(ROTATIONS)}")
+        self.rotation = degrees
+        self.rotate = ROTATIONS[degrees]
+        if self.rotate is not None and STAGE_ROTATE not in self.stages:
+            stages = list(self.stages)
+            position = stages.index(STAGE_ENCODE) if STAGE_ENCODE in stages else len(stages)
+            stages.insert(position, STAGE_ROTATE)
+            self.configure(stages)
+
+    def run(self, img, on_encoded=None, output=True):
+        """Прогоняет кадр через этапы; возвращает JPEG (bytes) или None без этапа encode.
+
+        С on_encoded(jpeg, image) JPEG и обработанный кадр (собственная копия,
+        её можно хранить) передаются в колбэк — сразу или из пула процессов, —
+        а run() возвращает None. Ссылку на входной кадр наружу не отдаём: он
+        может указывать на буфер SDK. output=False — только этапы вне
+        OUTPUT_STAGES (замер, денойзер), без JPEG.
+        """
+        frame = ProcessedFrame(img)
+        frame.on_encoded = on_encoded
+        frame_start = time.perf_counter()
+        for name in self.stages:
+            if not output and name in OUTPUT_STAGES:
+                continue
+            start = time.perf_counter()
+            STAGES[name](self, frame)
+            self.timings[name].record((time.perf_counter() - start) * 1000.0)
+        if not output:
+            return None
+        self.timings["total"].record((time.perf_counter() - frame_start) * 1000.0)
+        if on_encoded is not None and frame.jpeg is not None:
+            on_encoded(frame.jpeg, frame.owned_image())
+            return None
+        return frame.jpeg
+
+    def status(self):
+        return {
+            "stages": list(self.stages),
+            "rotate": self.rotation,
+            "encoder": self.encoder.name if self.encoder is not None else "opencv",
+            "available": list(STAGES),
+            "timings": {name: timer.status() for name, timer in self.timings.items()},
+            "encode_pool": self.encode_pool.status() if self.encode_pool is not None else None
+        }
@@ -23,6 +23,7 @@ let uploadedRoute = null;
 // Переменные для управления анимацией полета
 let isPlaying = false;    // Флаг, идет ли воспроизведение анимации
 let routePoints = [];     // Массив точек маршрута для анимации
+let srtName = null;       // Имя импортированного SRT — по нему сервер находит синхронное видео
 
 // Метка для отображения текущего положения БПЛА на карте
 let uavPlacemark;
@@ -856,6 +857,7 @@ async function parseSRTFile(file) {
 
         if (data.status === 'success') {
             routePoints = data.points;
+            srtName = data.name || null;
             displayRoute(routePoints);
             updateChart(routePoints);
             if (routePoints.length > 0) showCameraParams(routePoints[0]);
@@ -934,7 +936,8 @@ function toggleAnimation() {
         }
 
         // Start the video stream with current timestamp to avoid caching
-        videoStream.src = `http://localhost:8000/video_feed_sync?t=${Date.now()}`;
+        const nameParam = srtName ? `&name=${encodeURIComponent(srtName)}` : '';
+        videoStream.src = `http://localhost:8000/video_feed_sync?t=${Date.now()}${nameParam}`;
 
         // Initialize animation variables
         videoFrameCount = 0;